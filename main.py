@@ -1,18 +1,41 @@
+import abc
 import os
+import sys
+import asyncio
+import argparse
+import subprocess
+import statistics
 import logging
+import threading
 import datetime
+import time
+import sqlite3
 import io
 import base64
-from typing import Optional, List, Dict, Any
-import matplotlib.pyplot as plt
-import numpy as np
-import pandas as pd
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib import colors
-from reportlab.lib.units import inch
-from langchain_openai import ChatOpenAI
+import json
+import math
+import re
+import hashlib
+import random
+import shutil
+import weakref
+import tempfile
+import tracemalloc
+import uuid
+import contextlib
+import itertools
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Optional, List, Dict, Any, Awaitable, Callable, Iterable, Iterator, Tuple, Union
+from xml.sax.saxutils import escape as xml_escape
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# matplotlib, numpy, reportlab and langchain_openai are heavy to import and
+# are loaded on first use so that text-only runs start quickly.
 
 # Configure logging
 logging.basicConfig(
@@ -21,306 +44,3337 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Embedded API configuration
-OPENAI_API_KEY = ""  # Replace with your actual API key
-OPENAI_BASE_URL = "" #add your actual base url
+# Embedded API configuration
+OPENAI_API_KEY = ""  # Replace with your actual API key
+OPENAI_BASE_URL = "" #add your actual base url
+
+# Local cache of LLM responses used by the interactive assistant
+LLM_CACHE_PATH = "llm_cache.sqlite"
+
+# Similarity index of custom instructions used by --dedup
+INSTRUCTION_INDEX_PATH = "instruction_index.json"
+INSTRUCTION_INDEX_THRESHOLD = 0.8
+
+# How much of a similar earlier report is given to the LLM in "seed" mode
+INSTRUCTION_REFERENCE_CHARS = 8000
+
+# HTTP settings for the shared OpenAI client
+LLM_CONNECT_TIMEOUT_S = 10.0
+LLM_READ_TIMEOUT_S = 300.0
+LLM_MAX_CONNECTIONS = 100
+LLM_MAX_KEEPALIVE_CONNECTIONS = 20
+
+# Retries of transient LLM errors (rate limits, timeouts, connection and 5xx errors)
+LLM_MAX_ATTEMPTS = 5
+LLM_RETRY_BASE_S = 1.0
+LLM_RETRY_MAX_S = 60.0
+
+# Client-side budgets shared by every agent in the process (None means unlimited)
+LLM_REQUESTS_PER_MINUTE: Optional[int] = None
+LLM_TOKENS_PER_MINUTE: Optional[int] = None
+
+# Output tokens assumed per call when reserving token budget before the call
+LLM_EXPECTED_OUTPUT_TOKENS = 1500
+
+# Root directory for generated reports, charts and text output
+OUTPUT_ROOT = "outputs"
+
+# Generated output older than this many days is removed by cleanup
+OUTPUT_RETENTION_DAYS = 30
+
+# How often the job service applies the retention policy
+OUTPUT_CLEANUP_INTERVAL_S = 3600.0
+
+# Default chart size in inches and resolution
+CHART_FIGSIZE = (10, 6)
+CHART_DPI = 100
+
+# Part of every chart cache key; bump it when the renderers change how charts look
+CHART_RENDER_VERSION = 3
+
+# On-disk cache of rendered charts shared by runs and processes
+CHART_CACHE_DIR = "chart_cache"
+CHART_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Job queue used by the "serve", "submit" and "status" commands
+JOB_QUEUE_PATH = "jobs.sqlite"
+JOB_QUEUE_MAX_PENDING = 1000
+JOB_LEASE_SECONDS = 300.0
+JOB_MAX_ATTEMPTS = 3
+JOB_SERVICE_HOST = "127.0.0.1"
+JOB_SERVICE_PORT = 8765
+
+# JSON schema for chart data returned through structured output
+CHARTS_SCHEMA = {
+    "title": "report_charts",
+    "description": "Data for the charts that accompany the report.",
+    "type": "object",
+    "properties": {
+        "charts": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string"},
+                    "type": {"type": "string", "enum": ["line", "bar", "pie", "scatter"]},
+                    "x_label": {"type": "string"},
+                    "y_label": {"type": "string"},
+                    "data": {
+                        "type": "object",
+                        "properties": {
+                            "labels": {"type": "array", "items": {"type": "string"}},
+                            "datasets": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "label": {"type": "string"},
+                                        "values": {"type": "array", "items": {"type": "number"}}
+                                    },
+                                    "required": ["label", "values"],
+                                    "additionalProperties": False
+                                }
+                            }
+                        },
+                        "required": ["labels", "datasets"],
+                        "additionalProperties": False
+                    }
+                },
+                "required": ["title", "type", "x_label", "y_label", "data"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["charts"],
+    "additionalProperties": False
+}
+
+# JSON schema for a full report: the prose and its charts as separate fields
+REPORT_SCHEMA = {
+    "title": "report",
+    "description": "A markdown report and the data for its charts.",
+    "type": "object",
+    "properties": {
+        "text_content": {"type": "string", "description": "The full response in markdown."},
+        "charts": CHARTS_SCHEMA["properties"]["charts"]
+    },
+    "required": ["text_content", "charts"],
+    "additionalProperties": False
+}
+
+# How much of the response is sent back when asking the LLM to repair chart data
+CHART_REPAIR_CONTEXT_CHARS = 12000
+
+# Category axes show at most this many tick labels
+MAX_CATEGORY_TICKS = 30
+
+# Longest run of lines laid out as a single PDF paragraph
+PDF_MAX_PARAGRAPH_LINES = 40
+
+# Most of the page height a table header may take and still be repeated on every page
+PDF_TABLE_HEADER_FRACTION = 0.25
+
+# Code lines in PDF reports are wrapped after this many characters
+PDF_CODE_LINE_LENGTH = 95
+
+# Planner mode: most sections an instruction is split into, and attempts per section
+PLANNER_MAX_SECTIONS = 6
+PLANNER_SECTION_ATTEMPTS = 2
+
+# Instructions for the predefined tasks offered in the menu and in batch jobs
+PREDEFINED_TASKS = {
+    "basic": "Research renewable energy trends over the past decade. Create charts showing the growth "
+            "of solar, wind, and hydroelectric power. Generate a PDF report with your findings and visualizations.",
+    
+    "intermediate": "Compare key economic indicators (GDP growth, inflation, unemployment) for the top 5 "
+                   "global economies over the past 5 years. Create appropriate visualizations for each indicator "
+                   "and compile your analysis into a comprehensive PDF report.",
+    
+    "advanced": "Analyze climate change data including global temperature changes, sea level rise, and carbon "
+               "emissions over the past century. Create multiple visualizations showing these trends and their "
+               "correlations. Compile a detailed PDF report with your analysis, visualizations, and potential "
+               "future scenarios based on current trends."
+}
+
+
+class ChartArtifact:
+    """A rendered chart image kept in memory.
+    
+    Artifacts are shared between runs through ChartArtifactStore, so they
+    are never modified after creation; each run tracks its own file paths.
+    """
+    
+    def __init__(self, key: str, title: str, png_bytes: bytes):
+        """Initialize the artifact with its spec hash and PNG data."""
+        self.key = key
+        self.title = title
+        self.png_bytes = png_bytes
+    
+    def open(self) -> io.BytesIO:
+        """Return a fresh in-memory buffer over the PNG data."""
+        return io.BytesIO(self.png_bytes)
+
+
+class ChartDiskCache:
+    """Content-addressed on-disk cache of rendered chart PNGs.
+    
+    Files are named after the chart's spec key, so a chart is only rendered
+    again when its spec changes. Once the files take up more than max_bytes,
+    the least recently used ones are removed (reads refresh a file's
+    modification time) until the cache is back under 90% of the limit.
+    Writes are atomic, so several processes can share one directory.
+    """
+    
+    def __init__(self, directory: str = CHART_CACHE_DIR, max_bytes: int = CHART_CACHE_MAX_BYTES):
+        """Initialize the cache in directory, creating it if needed."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes = sum(size for _, _, size in self._files())
+    
+    def _path(self, key: str) -> str:
+        """Return the file path for key, sharded by its first two characters."""
+        return os.path.join(self.directory, key[:2], f"{key}.png")
+    
+    def _files(self) -> List[Tuple[float, str, int]]:
+        """Return (mtime, path, size) for every cached file."""
+        files = []
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".png"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, entry.path, stat.st_size))
+        return files
+    
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the cached PNG for key, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                png_bytes = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        
+        with self._lock:
+            self.hits += 1
+        return png_bytes
+    
+    def put(self, key: str, png_bytes: bytes) -> None:
+        """Store the PNG for key and evict old files if the cache is over its limit."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, png_bytes)
+        
+        with self._lock:
+            self._total_bytes += len(png_bytes)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+    
+    def _evict(self) -> None:
+        """Remove the least recently used files until the cache is under 90% of max_bytes."""
+        files = sorted(self._files())
+        total = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        self._total_bytes = total
+    
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss counters and the cached bytes."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes": self._total_bytes}
+
+
+class ChartArtifactStore:
+    """Keeps rendered chart artifacts keyed by a content hash of their spec.
+    
+    Artifacts are held in memory, and also in disk_cache when one is given,
+    so that charts survive across runs and processes.
+    """
+    
+    def __init__(self, max_entries: int = 256, disk_cache: Optional[ChartDiskCache] = None):
+        """Initialize an empty store holding at most max_entries artifacts in memory."""
+        self.max_entries = max_entries
+        self.disk_cache = disk_cache
+        self._artifacts: "OrderedDict[str, ChartArtifact]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def spec_key(chart: Dict[str, Any], figsize: Tuple[float, float] = CHART_FIGSIZE, dpi: int = CHART_DPI) -> str:
+        """Return a stable content hash of everything that affects how a chart is drawn.
+        
+        Only the fields the renderers read are hashed, together with the
+        figure size, DPI and CHART_RENDER_VERSION. Values are hashed as the
+        raw bytes of a float64 array, which keeps this cheap for large
+        series; extra keys or 1 versus 1.0 give the same key.
+        """
+        import numpy as np
+        
+        data = chart.get("data") or {}
+        datasets = [dataset for dataset in data.get("datasets", []) if isinstance(dataset, dict)]
+        canonical = json.dumps(
+            {
+                "version": CHART_RENDER_VERSION,
+                "type": chart.get("type", "bar"),
+                "title": chart.get("title"),
+                "x_label": chart.get("x_label", ""),
+                "y_label": chart.get("y_label", ""),
+                "labels": data.get("labels", []),
+                "datasets": [dataset.get("label", f"Dataset {j+1}") for j, dataset in enumerate(datasets)],
+                "figsize": list(figsize),
+                "dpi": dpi
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+            default=str
+        )
+        
+        digest = hashlib.sha256(canonical.encode("utf-8"))
+        for dataset in datasets:
+            values = np.asarray(dataset.get("values", []), dtype="<f8")
+            # The length keeps the boundary between datasets in the hash
+            digest.update(values.size.to_bytes(8, "little"))
+            digest.update(values.tobytes())
+        return digest.hexdigest()
+    
+    def get(self, key: str) -> Optional[ChartArtifact]:
+        """Return the artifact stored under key, or None if it is missing."""
+        with self._lock:
+            artifact = self._artifacts.get(key)
+            if artifact is not None:
+                self._artifacts.move_to_end(key)
+                return artifact
+        
+        if self.disk_cache is None:
+            return None
+        
+        png_bytes = self.disk_cache.get(key)
+        if png_bytes is None:
+            return None
+        
+        artifact = ChartArtifact(key, "", png_bytes)
+        self._remember(artifact)
+        return artifact
+    
+    def _remember(self, artifact: ChartArtifact) -> None:
+        """Keep an artifact in memory, evicting the oldest entries if needed."""
+        with self._lock:
+            self._artifacts[artifact.key] = artifact
+            self._artifacts.move_to_end(artifact.key)
+            while len(self._artifacts) > self.max_entries:
+                self._artifacts.popitem(last=False)
+    
+    def put(self, artifact: ChartArtifact) -> None:
+        """Store an artifact in memory and in the disk cache."""
+        self._remember(artifact)
+        if self.disk_cache is not None:
+            try:
+                self.disk_cache.put(artifact.key, artifact.png_bytes)
+            except Exception as e:
+                logger.error(f"Error writing chart cache: {str(e)}")
+
+
+@contextlib.contextmanager
+def atomic_output(path: str):
+    """Yield a temporary path next to path and move it into place on success.
+    
+    Readers never see a partially written file: the rename only happens once
+    the body of the with block has finished without raising.
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix="-" + os.path.basename(path))
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_write(path: str, data: Union[str, bytes]) -> str:
+    """Atomically write text or bytes to path and return the path."""
+    with atomic_output(path) as tmp_path:
+        if isinstance(data, str):
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                file.write(data)
+        else:
+            with open(tmp_path, "wb") as file:
+                file.write(data)
+    return path
+
+
+class OutputManager:
+    """Gives each run its own directory in a date- and hash-sharded layout.
+    
+    Run directories look like <root>/YYYY/MM/DD/<shard>/<job_id>, where the
+    shard is the first two hex digits of a hash of the job id, so no single
+    directory grows without bound.
+    """
+    
+    def __init__(self, root: str = OUTPUT_ROOT, retention_days: Optional[float] = OUTPUT_RETENTION_DAYS):
+        """Initialize the manager; retention_days=None keeps output forever."""
+        self.root = root
+        self.retention_days = retention_days
+    
+    def new_run(self, prefix: str = "run") -> str:
+        """Create and return a new, unique run directory."""
+        now = datetime.datetime.now()
+        safe_prefix = re.sub(r"[^A-Za-z0-9_.-]", "_", prefix)[:64] or "run"
+        job_id = f"{safe_prefix}_{now.strftime('%H%M%S')}_{uuid.uuid4().hex[:12]}"
+        shard = hashlib.sha1(job_id.encode("utf-8")).hexdigest()[:2]
+        
+        run_dir = os.path.join(self.root, now.strftime("%Y"), now.strftime("%m"), now.strftime("%d"), shard, job_id)
+        os.makedirs(run_dir)
+        return run_dir
+    
+    def cleanup(self, now: Optional[datetime.datetime] = None) -> int:
+        """Remove day directories older than the retention period.
+        
+        Returns the number of day directories removed.
+        """
+        if self.retention_days is None or not os.path.isdir(self.root):
+            return 0
+        
+        cutoff = (now or datetime.datetime.now()) - datetime.timedelta(days=self.retention_days)
+        removed = 0
+        
+        for year in sorted(os.listdir(self.root)):
+            year_dir = os.path.join(self.root, year)
+            if not (year.isdigit() and os.path.isdir(year_dir)):
+                continue
+            
+            for month in sorted(os.listdir(year_dir)):
+                month_dir = os.path.join(year_dir, month)
+                if not (month.isdigit() and os.path.isdir(month_dir)):
+                    continue
+                
+                for day in sorted(os.listdir(month_dir)):
+                    day_dir = os.path.join(month_dir, day)
+                    try:
+                        day_end = datetime.datetime(int(year), int(month), int(day)) + datetime.timedelta(days=1)
+                    except ValueError:
+                        continue
+                    
+                    if day_end <= cutoff:
+                        shutil.rmtree(day_dir, ignore_errors=True)
+                        removed += 1
+                
+                # Drop month and year directories left empty
+                with contextlib.suppress(OSError):
+                    os.rmdir(month_dir)
+            
+            with contextlib.suppress(OSError):
+                os.rmdir(year_dir)
+        
+        if removed:
+            logger.info(f"Removed {removed} expired output directories from {self.root}")
+        return removed
+
+
+def _peak_rss_bytes() -> Optional[int]:
+    """Return the peak resident set size of this process since it started, if it can be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RunMemoryTracker:
+    """Measures the peak Python memory of each run while tracemalloc is tracing.
+    
+    tracemalloc keeps a single peak for the whole process, so it is only
+    reset when no other run is active. A run that overlapped other runs
+    reports the peak of all of them and is marked as shared.
+    """
+    
+    def __init__(self):
+        """Initialize the tracker with no active runs."""
+        self._lock = threading.Lock()
+        self._active = 0
+        self._begun = 0
+    
+    def begin(self) -> Optional[Tuple[int, int, int]]:
+        """Register a starting run; returns a token for end(), or None when not tracing."""
+        if not tracemalloc.is_tracing():
+            return None
+        with self._lock:
+            if self._active == 0:
+                tracemalloc.reset_peak()
+            self._active += 1
+            self._begun += 1
+            return self._begun, self._active, tracemalloc.get_traced_memory()[0]
+    
+    def end(self, token: Optional[Tuple[int, int, int]]) -> Optional[Dict[str, Any]]:
+        """Unregister a run and return its peak above the memory in use when it began."""
+        if token is None:
+            return None
+        begun, active, baseline = token
+        with self._lock:
+            self._active -= 1
+            if not tracemalloc.is_tracing():
+                return None
+            peak = tracemalloc.get_traced_memory()[1]
+            return {
+                "peak_bytes": max(0, peak - baseline),
+                "shared": active > 1 or self._begun > begun
+            }
+
+
+# Shared by every run in the process
+run_memory_tracker = RunMemoryTracker()
+
+
+class RunMetrics:
+    """Collects per-stage wall time, token counts and bytes written for one run.
+    
+    With track_memory, and while tracemalloc is tracing, the run's peak
+    Python memory and the memory each stage added are recorded as well;
+    finish() must then be called when the run ends.
+    """
+    
+    def __init__(self, track_memory: bool = False):
+        """Start the run clock with empty counters."""
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.stages: Dict[str, float] = {}
+        self.stage_memory: Dict[str, int] = {}
+        self.counters: Dict[str, int] = {}
+        self.charts: List[Dict[str, Any]] = []
+        self.memory: Optional[Dict[str, Any]] = None
+        self._memory_token = run_memory_tracker.begin() if track_memory else None
+    
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Time the body of the with block as stage name."""
+        start = time.perf_counter()
+        tracing = self._memory_token is not None and tracemalloc.is_tracing()
+        memory_before = tracemalloc.get_traced_memory()[0] if tracing else 0
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start)
+            if tracing and tracemalloc.is_tracing():
+                with self._lock:
+                    self.stage_memory[name] = (
+                        self.stage_memory.get(name, 0) + tracemalloc.get_traced_memory()[0] - memory_before
+                    )
+    
+    def record_stage(self, name: str, seconds: float) -> None:
+        """Add seconds of wall time to stage name."""
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+    
+    def add(self, name: str, value: int = 1) -> None:
+        """Increment counter name by value."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def record_usage(self, message: Any) -> None:
+        """Add the token counts from an LLM message's usage metadata."""
+        usage = getattr(message, "usage_metadata", None) or {}
+        for name in ("input_tokens", "output_tokens", "total_tokens"):
+            if usage.get(name):
+                self.add(name, usage[name])
+    
+    def record_file(self, path: str) -> None:
+        """Count the size of a file that was written during the run."""
+        self.add("bytes_written", os.path.getsize(path))
+    
+    def record_chart(self, title: str, render_time_s: Optional[float], reused: bool) -> None:
+        """Record how a single chart was obtained."""
+        with self._lock:
+            self.charts.append({
+                "title": title,
+                "render_time_s": None if render_time_s is None else round(render_time_s, 6),
+                "reused": reused
+            })
+    
+    def finish(self) -> None:
+        """Stop measuring the run's memory; later calls do nothing."""
+        with self._lock:
+            token, self._memory_token = self._memory_token, None
+        memory = run_memory_tracker.end(token)
+        if memory is not None:
+            with self._lock:
+                self.memory = memory
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Return the collected metrics as plain data."""
+        with self._lock:
+            memory = None
+            if self.memory is not None:
+                memory = dict(self.memory, stage_bytes=dict(self.stage_memory))
+            return {
+                "total_time_s": round(time.perf_counter() - self._started, 6),
+                "stages": {name: round(seconds, 6) for name, seconds in self.stages.items()},
+                "tokens": {
+                    name: self.counters.get(name, 0)
+                    for name in ("input_tokens", "output_tokens", "total_tokens")
+                },
+                "llm_calls": self.counters.get("llm_calls", 0),
+                "llm_cache_hits": self.counters.get("llm_cache_hits", 0),
+                "bytes_written": self.counters.get("bytes_written", 0),
+                "pdf_pages": self.counters.get("pdf_pages", 0),
+                "charts": list(self.charts),
+                "memory": memory,
+                "process_peak_rss_bytes": _peak_rss_bytes()
+            }
+
+
+class MetricsSink(abc.ABC):
+    """Receives the metrics of every finished run."""
+    
+    @abc.abstractmethod
+    def emit(self, metrics: Dict[str, Any]) -> None:
+        """Handle the metrics dict of one run."""
+
+
+class JSONLinesMetricsSink(MetricsSink):
+    """Appends the metrics of each run as one JSON line to a file."""
+    
+    def __init__(self, path: str):
+        """Initialize the sink writing to path."""
+        self.path = path
+        self._lock = threading.Lock()
+    
+    def emit(self, metrics: Dict[str, Any]) -> None:
+        """Append the run metrics with a timestamp."""
+        record = dict(metrics, timestamp=datetime.datetime.now().isoformat())
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(record) + "\n")
+
+
+class PrometheusMetricsSink(MetricsSink):
+    """Aggregates run metrics and renders them in the Prometheus text format.
+    
+    If textfile_path is given, the exposition is rewritten there after every
+    run, which suits the node_exporter textfile collector.
+    """
+    
+    def __init__(self, textfile_path: Optional[str] = None):
+        """Initialize empty aggregates."""
+        self.textfile_path = textfile_path
+        self._lock = threading.Lock()
+        self._runs = 0
+        self._stage_seconds: Dict[str, float] = {}
+        self._stage_counts: Dict[str, int] = {}
+        self._counters: Dict[str, int] = {}
+        self._chart_renders = 0
+        self._chart_render_seconds = 0.0
+        self._process_peak_rss_bytes: Optional[int] = None
+        self._run_peak_memory_bytes: Optional[int] = None
+    
+    def emit(self, metrics: Dict[str, Any]) -> None:
+        """Fold one run into the aggregates."""
+        with self._lock:
+            self._runs += 1
+            for stage, seconds in metrics.get("stages", {}).items():
+                self._stage_seconds[stage] = self._stage_seconds.get(stage, 0.0) + seconds
+                self._stage_counts[stage] = self._stage_counts.get(stage, 0) + 1
+            
+            counters = dict(metrics.get("tokens", {}))
+            for name in ("llm_calls", "llm_cache_hits", "bytes_written", "pdf_pages"):
+                counters[name] = metrics.get(name, 0)
+            for name, value in counters.items():
+                self._counters[name] = self._counters.get(name, 0) + value
+            
+            for chart in metrics.get("charts", []):
+                if chart.get("render_time_s") is not None:
+                    self._chart_renders += 1
+                    self._chart_render_seconds += chart["render_time_s"]
+            
+            if metrics.get("process_peak_rss_bytes") is not None:
+                self._process_peak_rss_bytes = max(self._process_peak_rss_bytes or 0, metrics["process_peak_rss_bytes"])
+            if metrics.get("memory"):
+                self._run_peak_memory_bytes = max(self._run_peak_memory_bytes or 0, metrics["memory"]["peak_bytes"])
+        
+        if self.textfile_path:
+            atomic_write(self.textfile_path, self.render())
+    
+    def render(self) -> str:
+        """Return the aggregates in the Prometheus text exposition format."""
+        with self._lock:
+            lines = [
+                "# TYPE agent_runs_total counter",
+                f"agent_runs_total {self._runs}",
+                "# TYPE agent_stage_seconds summary",
+            ]
+            for stage in sorted(self._stage_seconds):
+                lines.append(f'agent_stage_seconds_sum{{stage="{stage}"}} {self._stage_seconds[stage]:.6f}')
+                lines.append(f'agent_stage_seconds_count{{stage="{stage}"}} {self._stage_counts[stage]}')
+            
+            for name in sorted(self._counters):
+                lines.append(f"# TYPE agent_{name}_total counter")
+                lines.append(f"agent_{name}_total {self._counters[name]}")
+            
+            lines.append("# TYPE agent_chart_render_seconds summary")
+            lines.append(f"agent_chart_render_seconds_sum {self._chart_render_seconds:.6f}")
+            lines.append(f"agent_chart_render_seconds_count {self._chart_renders}")
+            
+            if self._process_peak_rss_bytes is not None:
+                lines.append("# TYPE agent_process_peak_rss_bytes gauge")
+                lines.append(f"agent_process_peak_rss_bytes {self._process_peak_rss_bytes}")
+            if self._run_peak_memory_bytes is not None:
+                lines.append("# TYPE agent_run_peak_memory_bytes gauge")
+                lines.append(f"agent_run_peak_memory_bytes {self._run_peak_memory_bytes}")
+        
+        return "\n".join(lines) + "\n"
+
+
+class RateLimiter:
+    """Token-bucket limiter for requests-per-minute and tokens-per-minute budgets.
+    
+    Thread-safe, with blocking and async acquire. A budget of None is not
+    enforced.
+    """
+    
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        """Initialize full buckets for the given budgets."""
+        self._capacity = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self._level = {kind: float(capacity or 0) for kind, capacity in self._capacity.items()}
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _reserve(self, tokens: int) -> float:
+        """Take one request and tokens from the buckets, or return how long to wait."""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._updated
+            self._updated = now
+            
+            wait = 0.0
+            wanted = {"requests": 1, "tokens": tokens}
+            for kind, capacity in self._capacity.items():
+                if not capacity:
+                    continue
+                self._level[kind] = min(capacity, self._level[kind] + elapsed * capacity / 60.0)
+                deficit = min(wanted[kind], capacity) - self._level[kind]
+                if deficit > 0:
+                    wait = max(wait, deficit * 60.0 / capacity)
+            
+            if wait == 0.0:
+                for kind, capacity in self._capacity.items():
+                    if capacity:
+                        self._level[kind] -= min(wanted[kind], capacity)
+            return wait
+    
+    def acquire(self, tokens: int = 0) -> None:
+        """Block until one request using tokens fits in the budgets."""
+        wait = self._reserve(tokens)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self._reserve(tokens)
+    
+    async def aacquire(self, tokens: int = 0) -> None:
+        """Async variant of acquire."""
+        wait = self._reserve(tokens)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self._reserve(tokens)
+    
+    def adjust(self, tokens: int) -> None:
+        """Charge (or refund, if negative) tokens once the real usage is known."""
+        with self._lock:
+            if self._capacity["tokens"]:
+                self._level["tokens"] = min(self._capacity["tokens"], self._level["tokens"] - tokens)
+
+
+class LLMClientFactory:
+    """Builds ChatOpenAI clients that share keep-alive HTTP connection pools.
+    
+    One synchronous httpx pool is shared by every client in the process.
+    httpx async pools are tied to the event loop that uses them, so async
+    clients are shared per running loop instead. Call aclose_loop() before
+    a loop ends (EnhancedLLMAgent.run_async does) to close its pool; pools
+    of loops that were closed without it are dropped on the next lookup.
+    """
+    
+    def __init__(self, connect_timeout: float = LLM_CONNECT_TIMEOUT_S, read_timeout: float = LLM_READ_TIMEOUT_S,
+                 max_connections: int = LLM_MAX_CONNECTIONS,
+                 max_keepalive_connections: int = LLM_MAX_KEEPALIVE_CONNECTIONS,
+                 requests_per_minute: Optional[int] = LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: Optional[int] = LLM_TOKENS_PER_MINUTE):
+        """Initialize the factory; HTTP pools are created on first use."""
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self._lock = threading.Lock()
+        self._http_client = None
+        self._clients: Dict[Tuple, Any] = {}
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple, Any]]" = (
+            weakref.WeakKeyDictionary()
+        )
+    
+    def _timeout(self):
+        """Return the httpx timeout with explicit connect and read limits."""
+        import httpx
+        
+        return httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+    
+    def _limits(self):
+        """Return the httpx connection pool limits."""
+        import httpx
+        
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections
+        )
+    
+    def _build(self, key: Tuple, http_client: Any, http_async_client: Any):
+        """Create a ChatOpenAI client for key on the given HTTP pools."""
+        from langchain_openai import ChatOpenAI
+        
+        model, temperature, base_url, api_key = key
+        return ChatOpenAI(
+            model=model,
+            temperature=temperature,
+            max_tokens=None,
+            timeout=self._timeout(),
+            # Retries are done by the agent with jittered backoff
+            max_retries=0,
+            stream_usage=True,
+            base_url=base_url,
+            api_key=api_key,
+            http_client=http_client,
+            http_async_client=http_async_client,
+        )
+    
+    def get_llm(self, model: str, temperature: float, base_url: Optional[str], api_key: str):
+        """Return the shared client for these settings, for use outside an event loop."""
+        import httpx
+        
+        key = (model, temperature, base_url or None, api_key)
+        with self._lock:
+            if self._http_client is None:
+                self._http_client = httpx.Client(timeout=self._timeout(), limits=self._limits())
+            if key not in self._clients:
+                self._clients[key] = self._build(key, self._http_client, None)
+            return self._clients[key]
+    
+    def get_async_llm(self, model: str, temperature: float, base_url: Optional[str], api_key: str):
+        """Return the shared client for these settings bound to the running event loop."""
+        import httpx
+        
+        loop = asyncio.get_running_loop()
+        key = (model, temperature, base_url or None, api_key)
+        # Make sure the shared synchronous pool exists as well
+        self.get_llm(model, temperature, base_url, api_key)
+        
+        with self._lock:
+            # The clients hold a reference to their loop, so closed loops are never collected on their own
+            for closed_loop in [other for other in self._async_clients if other.is_closed()]:
+                del self._async_clients[closed_loop]
+            
+            loop_clients = self._async_clients.setdefault(loop, {})
+            if "http" not in loop_clients:
+                loop_clients["http"] = httpx.AsyncClient(timeout=self._timeout(), limits=self._limits())
+            if key not in loop_clients:
+                loop_clients[key] = self._build(key, self._http_client, loop_clients["http"])
+            return loop_clients[key]
+    
+    async def aclose_loop(self) -> None:
+        """Close the async HTTP pool of the running event loop and forget its clients."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            loop_clients = self._async_clients.pop(loop, None)
+        if loop_clients and "http" in loop_clients:
+            await loop_clients["http"].aclose()
+
+
+# Process-wide factory used by agents that are not given their own LLM
+shared_client_factory = LLMClientFactory()
+
+
+def _estimate_tokens(prompt: Any) -> int:
+    """Estimate the tokens a call will use, at roughly four characters per token."""
+    return len(str(prompt)) // 4 + LLM_EXPECTED_OUTPUT_TOKENS
+
+
+def _usage_total_tokens(response: Any) -> Optional[int]:
+    """Return the total tokens reported for an LLM response, if available."""
+    if isinstance(response, dict):
+        response = response.get("raw")
+    usage = getattr(response, "usage_metadata", None) or {}
+    return usage.get("total_tokens")
+
+
+# Exception class names (from openai and httpx) worth retrying
+RETRYABLE_ERRORS = {
+    "RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError",
+    "TimeoutException", "ConnectError", "RemoteProtocolError",
+}
+
+
+def _is_retryable_error(error: Exception) -> bool:
+    """Return whether error is a transient failure worth retrying."""
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+
+def _retry_delay(attempt: int, error: Optional[Exception] = None) -> float:
+    """Return a full-jitter exponential backoff delay for the given attempt.
+    
+    A Retry-After header on the error's response is honoured as a minimum.
+    """
+    delay = random.uniform(0, min(LLM_RETRY_MAX_S, LLM_RETRY_BASE_S * (2 ** attempt)))
+    
+    response = getattr(error, "response", None)
+    retry_after = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    try:
+        delay = max(delay, min(LLM_RETRY_MAX_S, float(retry_after)))
+    except (TypeError, ValueError):
+        pass
+    
+    return delay
+
+
+class LLMResponseCache:
+    """On-disk SQLite cache of LLM responses with TTL and size-bounded LRU eviction."""
+    
+    def __init__(self, path: str = "llm_cache.sqlite", ttl_seconds: Optional[float] = 7 * 24 * 3600,
+                 max_entries: int = 1000):
+        """Open (or create) the cache database at path.
+        
+        Entries older than ttl_seconds are treated as misses (None disables
+        expiry), and the least recently used entries are evicted once the
+        cache holds more than max_entries responses.
+        """
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._conn.commit()
+    
+    @staticmethod
+    def make_key(prompt: str, model: str, temperature: float, base_url: Optional[str]) -> str:
+        """Build a cache key from the normalized prompt and the model settings."""
+        normalized_prompt = " ".join(prompt.split())
+        payload = json.dumps(
+            [normalized_prompt, model, temperature, base_url or ""],
+            separators=(",", ":")
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for key, or None on a miss."""
+        now = time.time()
+        
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            
+            if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            
+            if row is None:
+                self.misses += 1
+                return None
+            
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+    
+    def set(self, key: str, response: str) -> None:
+        """Store a response under key and evict entries beyond max_entries."""
+        now = time.time()
+        
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            self._conn.execute(
+                """
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,)
+            )
+            self._conn.commit()
+    
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss counters and the number of stored entries."""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+    
+    def clear(self) -> None:
+        """Remove every cached response."""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+    
+    def close(self) -> None:
+        """Close the underlying database connection."""
+        with self._lock:
+            self._conn.close()
+
+
+# Words ignored when comparing instructions
+INSTRUCTION_STOPWORDS = {
+    "a", "an", "the", "of", "for", "and", "or", "to", "in", "on", "with", "about", "by",
+    "please", "me", "my", "i", "you", "can", "could", "would", "some", "this", "that", "is", "are",
+    "it", "its", "be", "as", "well", "also", "from", "at", "into", "what", "how", "using", "based",
+    "should", "will", "all", "these", "those", "your", "we", "our", "us",
+}
+
+# Generic request words that say what to produce rather than what about; they count little
+INSTRUCTION_TASK_WORDS = {
+    "analyze", "analysis", "analyses", "visualize", "visualization", "chart", "graph", "plot", "data", "report",
+    "create", "generate", "make", "produce", "write", "give", "provide", "show", "explain", "describe",
+    "summarize", "summary", "overview", "detailed", "comprehensive", "brief", "include", "information",
+    "pdf", "discuss", "compare", "comparison", "key", "insight", "global", "recent",
+}
+
+# Words that mean the same thing in an instruction, mapped to one of them
+INSTRUCTION_SYNONYMS = {
+    "worldwide": "global", "world": "global", "international": "global",
+    "latest": "recent", "current": "recent", "today": "recent",
+}
+
+# Weight of a task word relative to a topic word
+INSTRUCTION_TASK_WEIGHT = 0.25
+
+# Topic words at least this similar (Dice coefficient of character trigrams) count as the same word
+INSTRUCTION_WORD_SIMILARITY = 0.8
+
+# Suffix rewrites applied once per word, so inflections and British spellings compare equal
+_INSTRUCTION_SUFFIXES = (
+    ("isation", "ize"), ("ization", "ize"), ("ising", "ize"), ("izing", "ize"), ("ised", "ize"),
+    ("ized", "ize"), ("ises", "ize"), ("izes", "ize"), ("ise", "ize"),
+    ("ysing", "yze"), ("yzing", "yze"), ("ysed", "yze"), ("yzed", "yze"), ("yse", "yze"),
+    ("ies", "y"), ("ing", ""), ("ed", ""), ("ss", "ss"), ("s", ""),
+)
+
+_INSTRUCTION_WORD_RE = re.compile(r"[a-z0-9]+")
+
+# Words in an instruction that ask for charts, and for a PDF report
+VISUALIZATION_KEYWORDS = (
+    "chart", "graph", "plot", "figure", "visualization", "visualize", "visualisation", "visualise", "diagram"
+)
+PDF_KEYWORDS = ("pdf", "document", "report", "export")
+
+
+def analyze_instruction(instruction: str) -> Tuple[bool, bool]:
+    """Return whether the instruction asks for visualizations and for a PDF."""
+    lowered = instruction.lower()
+    needs_visualization = any(keyword in lowered for keyword in VISUALIZATION_KEYWORDS)
+    needs_pdf = any(keyword in lowered for keyword in PDF_KEYWORDS)
+    return needs_visualization, needs_pdf
+
+
+def _instruction_word(word: str) -> str:
+    """Reduce a word to a crude stem and map it through INSTRUCTION_SYNONYMS.
+    
+    The stems need not be real words; they only have to agree between two
+    instructions.
+    """
+    word = INSTRUCTION_SYNONYMS.get(word, word)
+    for suffix, replacement in _INSTRUCTION_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)] + replacement
+            break
+    return INSTRUCTION_SYNONYMS.get(word, word)
+
+
+_INSTRUCTION_TASK_STEMS = {_instruction_word(word) for word in INSTRUCTION_TASK_WORDS}
+
+
+def instruction_terms(instruction: str) -> Dict[str, float]:
+    """Return the instruction's word stems with their weights, ignoring stopwords and numbers.
+    
+    Topic words weigh 1 and task words INSTRUCTION_TASK_WEIGHT, so that
+    "laptop" versus "smartphone" outweighs the request boilerplate the two
+    instructions share.
+    """
+    terms: Dict[str, float] = {}
+    for word in _INSTRUCTION_WORD_RE.findall(instruction.lower()):
+        if word in INSTRUCTION_STOPWORDS or word.isdigit():
+            continue
+        stem = _instruction_word(word)
+        terms[stem] = INSTRUCTION_TASK_WEIGHT if stem in _INSTRUCTION_TASK_STEMS else 1.0
+    return terms
+
+
+def instruction_entities(instruction: str) -> List[str]:
+    """Return the capitalized words of an instruction that do not start a sentence, lowercased.
+    
+    These are mostly names such as "Europe" or "Tesla", which set the scope
+    of a report however similar the rest of the wording is.
+    """
+    entities = set()
+    for sentence in re.split(r"[.!?:;\n]+", instruction):
+        words = re.findall(r"[A-Za-z][\w-]*", sentence)
+        entities.update(word.lower() for word in words[1:] if word[0].isupper())
+    return sorted(entities)
+
+
+def _trigram_similarity(first: str, second: str) -> float:
+    """Return the Dice coefficient of two words' character trigrams."""
+    def trigrams(word: str) -> set:
+        padded = f" {word} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+    
+    first_grams, second_grams = trigrams(first), trigrams(second)
+    return 2 * len(first_grams & second_grams) / (len(first_grams) + len(second_grams))
+
+
+def _match_topic_words(query: Dict[str, float], stored: Dict[str, float]) -> Optional[Dict[str, str]]:
+    """Pair every topic word of query with one of stored, or return None if that is impossible.
+    
+    Words are paired when equal, or when both have at least four letters
+    and are INSTRUCTION_WORD_SIMILARITY alike (such as a typo). Returns the
+    query word for each stored word it was paired with.
+    """
+    query_topics = [term for term, weight in query.items() if weight == 1.0]
+    stored_topics = [term for term, weight in stored.items() if weight == 1.0]
+    if len(query_topics) != len(stored_topics):
+        return None
+    
+    pairs: Dict[str, str] = {}
+    unmatched = [term for term in stored_topics if term not in query]
+    for term in query_topics:
+        if term in stored:
+            pairs[term] = term
+            continue
+        candidates = [
+            other for other in unmatched
+            if min(len(term), len(other)) >= 4 and _trigram_similarity(term, other) >= INSTRUCTION_WORD_SIMILARITY
+        ]
+        if not candidates:
+            return None
+        best = max(candidates, key=lambda other: _trigram_similarity(term, other))
+        unmatched.remove(best)
+        pairs[best] = term
+    return pairs
+
+
+def instruction_similarity(query: Dict[str, float], stored: Dict[str, float]) -> float:
+    """Return the weighted Dice similarity of two instruction_terms results.
+    
+    Instructions about different topics score 0: every topic word of one
+    must have a counterpart in the other. Beyond that, the score measures
+    how much of the weighted wording the two share.
+    """
+    pairs = _match_topic_words(query, stored)
+    if pairs is None:
+        return 0.0
+    
+    # Count paired topic words under the query's spelling
+    stored = {pairs.get(term, term): weight for term, weight in stored.items()}
+    shared = sum(min(weight, stored[term]) for term, weight in query.items() if term in stored)
+    total = sum(query.values()) + sum(stored.values())
+    return 2 * shared / total if total else 0.0
+
+
+class InstructionIndex:
+    """In-process similarity index of past instructions and their results.
+    
+    Instructions only match when they mention the same numbers and names
+    and ask for the same outputs (charts, PDF), so "2023" never matches
+    "2024" and a report without charts is never served for a request for
+    charts. Beyond that, the similarity is the cosine similarity of vectors
+    from an embedder callable such as OpenAIEmbeddings().embed_query, or
+    without one the weighted overlap of their words (local, no network),
+    which also requires the same topic words (see instruction_similarity)
+    so that "laptop" never matches "smartphone".
+    INSTRUCTION_SIMILARITY_FIXTURE holds pairs a threshold must tell apart;
+    see check_instruction_threshold.
+    
+    In "serve" mode a match is meant to be returned as is; in "seed" mode
+    its report is given to the LLM as a starting point. The least recently
+    matched entries are evicted beyond max_entries, and entries older than
+    ttl_seconds are ignored. With a path, entries are kept in a JSON file
+    between sessions.
+    """
+    
+    MODES = ("serve", "seed")
+    
+    # Features stored instructions must share exactly with a query; see _scope
+    SCOPE_FEATURES = ("numbers", "entities", "requirements")
+    
+    def __init__(self, threshold: float = INSTRUCTION_INDEX_THRESHOLD, mode: str = "serve", max_entries: int = 500,
+                 ttl_seconds: Optional[float] = 7 * 24 * 3600,
+                 embedder: Optional[Callable[[str], List[float]]] = None, path: Optional[str] = None):
+        """Initialize the index, loading saved entries from path if it exists."""
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown index mode: {mode}")
+        
+        self.threshold = threshold
+        self.mode = mode
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.embedder = embedder
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    for entry in json.load(file):
+                        # Saved features may come from an older version of this class
+                        entry.update(self._scope(entry["instruction"]))
+                        entry["terms"] = instruction_terms(entry["instruction"])
+                        self._insert(entry)
+            except Exception as e:
+                logger.error(f"Error loading instruction index: {str(e)}")
+    
+    @staticmethod
+    def _normalize(instruction: str) -> str:
+        """Return the instruction lowercased with collapsed whitespace."""
+        return " ".join(instruction.lower().split())
+    
+    @staticmethod
+    def _scope(instruction: str) -> Dict[str, Any]:
+        """Return the features two instructions must share exactly to match.
+        
+        Those are the numbers and names they mention, and whether they ask
+        for charts and for a PDF, since a served result only has the outputs
+        its own instruction asked for.
+        """
+        return {
+            "numbers": sorted(set(re.findall(r"\d+(?:\.\d+)?", instruction))),
+            "entities": instruction_entities(instruction),
+            "requirements": list(analyze_instruction(instruction)),
+        }
+    
+    def _features(self, instruction: str) -> Dict[str, Any]:
+        """Return the comparison features of an instruction."""
+        features = self._scope(instruction)
+        features["terms"] = instruction_terms(instruction)
+        if self.embedder is not None:
+            features["vector"] = [float(value) for value in self.embedder(instruction)]
+        return features
+    
+    def _insert(self, entry: Dict[str, Any]) -> None:
+        """Add an entry and evict the least recently used ones beyond max_entries."""
+        key = self._normalize(entry["instruction"])
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def _similarity(self, features: Dict[str, Any], entry: Dict[str, Any]) -> float:
+        """Return the similarity between query features and an entry."""
+        if "vector" not in features:
+            return instruction_similarity(features["terms"], entry.get("terms", {}))
+        
+        # Embeddings already place synonyms close together, so the word gate does not apply
+        query, stored = features["vector"], entry.get("vector")
+        if not stored or len(stored) != len(query):
+            return 0.0
+        dot = sum(a * b for a, b in zip(query, stored))
+        norm = math.sqrt(sum(a * a for a in query)) * math.sqrt(sum(b * b for b in stored))
+        return dot / norm if norm else 0.0
+    
+    def lookup(self, instruction: str) -> Optional[Tuple[float, Dict[str, Any]]]:
+        """Return (similarity, entry) for the most similar stored instruction, or None.
+        
+        entry holds the stored "instruction" and its "result".
+        """
+        features = self._features(instruction)
+        now = time.time()
+        
+        with self._lock:
+            best_key, best_similarity = None, 0.0
+            for key, entry in list(self._entries.items()):
+                if self.ttl_seconds is not None and now - entry["created_at"] > self.ttl_seconds:
+                    del self._entries[key]
+                    continue
+                if any(entry.get(name) != features[name] for name in self.SCOPE_FEATURES):
+                    continue
+                
+                similarity = 1.0 if key == self._normalize(instruction) else self._similarity(features, entry)
+                if similarity > best_similarity:
+                    best_key, best_similarity = key, similarity
+            
+            if best_key is None or best_similarity < self.threshold:
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            return best_similarity, self._entries[best_key]
+    
+    def add(self, instruction: str, result: Dict[str, Any]) -> None:
+        """Store the result of an instruction, keeping only its reusable fields."""
+        entry = {
+            "instruction": instruction,
+            "result": {
+                key: result.get(key)
+                for key in ("text_content", "text_path", "charts_data", "chart_paths", "pdf_path", "run_dir")
+            },
+            "created_at": time.time(),
+        }
+        entry.update(self._features(instruction))
+        
+        with self._lock:
+            self._insert(entry)
+            if self.path:
+                atomic_write(self.path, json.dumps(list(self._entries.values())))
+    
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss counters and the number of stored entries."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+# Pairs of instructions with whether they ask for the same report
+INSTRUCTION_SIMILARITY_FIXTURE = [
+    ("Analyze global smartphone market share and visualize the data", "Analyze smartphone market share", False),
+    ("Analyze global smartphone market share and visualize the data",
+     "Analyse the global smartphone market share and visualise data", True),
+    ("Analyze global smartphone market share and visualize the data",
+     "Analyze worldwide smartphone market share and visualize the data", True),
+    ("Explain the current trends in renewable energy technology",
+     "Explain current trends in renewable energy technologies", True),
+    ("Create a chart of electric vehicle sales by country", "Make a chart showing electric vehicle sales by country", True),
+    ("Summarize the principles of quantum computing", "Give me a summary of quantum computing principles", True),
+    ("Compare solar and wind power costs in a PDF report", "Compare the costs of solar and wind power, with a PDF report", True),
+    ("Analyze smartphone market shares in 2023", "Please analyze the smartphone market share in 2023", True),
+    ("Analyze global smartphone market share and visualize the data",
+     "Analyze global laptop market share and visualize the data", False),
+    ("Analyze smartphone market share in Europe", "Analyze smartphone market share in Asia", False),
+    ("Analyze smartphone market share", "Analyze smartphone market share in Europe", False),
+    ("Explain trends in renewable energy", "Explain trends in nonrenewable energy", False),
+    ("Compare solar and wind power costs", "Compare solar and hydro power costs", False),
+    ("Analyze smartphone market share in 2023", "Analyze smartphone market share in 2024", False),
+    ("Summarize the principles of quantum computing", "Summarize the applications of quantum computing", False),
+    ("Analyze electric vehicle sales and visualize the data", "Analyze electric vehicle prices and visualize the data", False),
+]
+
+
+def check_instruction_threshold(threshold: float = INSTRUCTION_INDEX_THRESHOLD,
+                                pairs: Optional[List[Tuple[str, str, bool]]] = None) -> Dict[str, Any]:
+    """Score instruction pairs (INSTRUCTION_SIMILARITY_FIXTURE by default) with a local InstructionIndex.
+    
+    Returns each pair's similarity with the lowest score of the matching
+    pairs, the highest score of the others, and whether threshold falls
+    between them.
+    """
+    scored = []
+    for stored, query, same in pairs or INSTRUCTION_SIMILARITY_FIXTURE:
+        index = InstructionIndex(threshold=0.0)
+        index.add(stored, {})
+        match = index.lookup(query)
+        scored.append({"stored": stored, "query": query, "same": same, "similarity": match[0] if match else 0.0})
+    
+    lowest_same = min((pair["similarity"] for pair in scored if pair["same"]), default=1.0)
+    highest_different = max((pair["similarity"] for pair in scored if not pair["same"]), default=0.0)
+    return {
+        "pairs": scored,
+        "lowest_same": lowest_same,
+        "highest_different": highest_different,
+        "separates": highest_different < threshold <= lowest_same
+    }
+
+
+class StreamingResponseParser:
+    """Incrementally parses a streamed markdown response.
+    
+    Tokens are fed in as they arrive; feed() returns the events completed by
+    that chunk: ("section", (heading, text)) when a "## " section ends and
+    ("charts", charts_data) when the ```json chart block is closed.
+    """
+    
+    def __init__(self):
+        """Initialize the parser with empty state."""
+        self._pending = ""
+        self._in_code_block = False
+        self._code_is_json = False
+        self._code_lines: List[str] = []
+        self._heading: Optional[str] = None
+        self._section_lines: List[str] = []
+        self.charts_data: Optional[Dict[str, Any]] = None
+    
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """Consume a chunk of streamed text and return any completed events."""
+        events = []
+        self._pending += chunk
+        
+        # Only complete lines can be classified
+        while "\n" in self._pending:
+            line, self._pending = self._pending.split("\n", 1)
+            events.extend(self._feed_line(line))
+        
+        return events
+    
+    def close(self) -> List[Tuple[str, Any]]:
+        """Flush the trailing partial line and the last open section."""
+        events = []
+        if self._pending:
+            events.extend(self._feed_line(self._pending))
+            self._pending = ""
+        events.extend(self._finish_section())
+        return events
+    
+    def _feed_line(self, line: str) -> List[Tuple[str, Any]]:
+        """Classify a single complete line."""
+        stripped = line.strip()
+        
+        # Handle code fences
+        if stripped.startswith("```"):
+            if not self._in_code_block:
+                self._in_code_block = True
+                self._code_is_json = stripped[3:].strip().lower() == "json"
+                self._code_lines = []
+                return []
+            
+            self._in_code_block = False
+            if self._code_is_json and self.charts_data is None:
+                try:
+                    self.charts_data = validate_charts_data(json.loads("\n".join(self._code_lines)))
+                    return [("charts", self.charts_data)]
+                except ValueError:
+                    pass
+            return []
+        
+        if self._in_code_block:
+            self._code_lines.append(line)
+            return []
+        
+        # A new heading closes the previous section
+        if stripped.startswith("## "):
+            events = self._finish_section()
+            self._heading = stripped[3:].strip()
+            return events
+        
+        self._section_lines.append(line)
+        return []
+    
+    def _finish_section(self) -> List[Tuple[str, Any]]:
+        """Emit the current section if it has a heading or any text."""
+        text = "\n".join(self._section_lines).strip()
+        events = []
+        if self._heading is not None or text:
+            events.append(("section", (self._heading, text)))
+        self._heading = None
+        self._section_lines = []
+        return events
+
+
+class PreparedChartData:
+    """Chart labels and datasets converted once to aligned NumPy arrays.
+    
+    x holds the numeric labels, or the label positions when the labels are
+    categories; every dataset's values have the same length as x.
+    """
+    
+    def __init__(self, labels: List[Any], x, categorical: bool, datasets: List[Tuple[str, Any]]):
+        """Initialize the prepared data."""
+        self.labels = labels
+        self.x = x
+        self.categorical = categorical
+        self.datasets = datasets
+
+
+def prepare_chart_data(data: Dict[str, Any]) -> PreparedChartData:
+    """Convert a chart's labels and datasets to float arrays of equal length.
+    
+    Datasets longer than the labels are truncated and shorter ones are
+    padded with NaN (which matplotlib leaves blank). Without labels, points
+    are numbered from 1.
+    """
+    import numpy as np
+    
+    labels = list(data.get("labels", []))
+    raw_datasets = data.get("datasets", [])
+    length = len(labels) if labels else max((len(d.get("values", [])) for d in raw_datasets), default=0)
+    
+    datasets = []
+    for j, dataset in enumerate(raw_datasets):
+        dataset_label = dataset.get("label", f"Dataset {j+1}")
+        values = np.asarray(dataset.get("values", []), dtype=float)
+        if len(values) != length:
+            logger.warning(f"Dataset '{dataset_label}' has {len(values)} values for {length} labels, aligning")
+            aligned = np.full(length, np.nan)
+            aligned[:min(length, len(values))] = values[:length]
+            values = aligned
+        datasets.append((dataset_label, values))
+    
+    if not labels:
+        return PreparedChartData(list(range(1, length + 1)), np.arange(1, length + 1, dtype=float), False, datasets)
+    
+    categorical = not all(isinstance(label, (int, float)) and not isinstance(label, bool) for label in labels)
+    x = np.arange(length, dtype=float) if categorical else np.asarray(labels, dtype=float)
+    return PreparedChartData(labels, x, categorical, datasets)
+
+
+def lttb_indices(x, y, threshold: int):
+    """Return the indices of the points kept by Largest-Triangle-Three-Buckets.
+    
+    LTTB keeps the first and last points and, from each of threshold - 2
+    equal buckets in between, the point forming the largest triangle with
+    the previously kept point and the next bucket's average, which
+    preserves the visual shape of a line.
+    """
+    import numpy as np
+    
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    indices = np.empty(threshold, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+    
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    
+    return indices
+
+
+def minmax_indices(y, buckets: int):
+    """Return the indices of the minimum and maximum of y in each of buckets equal slices."""
+    import numpy as np
+    
+    n = len(y)
+    if n <= 2 * buckets:
+        return np.arange(n)
+    
+    size = n // buckets
+    offsets = np.arange(buckets) * size
+    grouped = y[:size * buckets].reshape(buckets, size)
+    tail = np.arange(size * buckets, n)
+    return np.unique(np.concatenate([offsets + grouped.argmin(axis=1), offsets + grouped.argmax(axis=1), tail]))
+
+
+def _finite_points(x, y):
+    """Return x and y without the points where either is NaN or infinite."""
+    import numpy as np
+    
+    mask = np.isfinite(x) & np.isfinite(y)
+    return x[mask], y[mask]
+
+
+def _set_category_ticks(ax, positions, labels: List[Any]) -> None:
+    """Label category positions, thinning the labels when there are too many."""
+    import numpy as np
+    
+    if len(labels) > MAX_CATEGORY_TICKS:
+        keep = np.unique(np.linspace(0, len(labels) - 1, MAX_CATEGORY_TICKS).astype(int))
+        positions = np.asarray(positions)[keep]
+        labels = [labels[i] for i in keep]
+        ax.tick_params(axis="x", labelrotation=45)
+    ax.set_xticks(positions)
+    ax.set_xticklabels(labels)
+
+
+def _draw_bar_chart(ax, prepared: PreparedChartData, max_points: int) -> None:
+    """Draw grouped bars, one group per label.
+    
+    When there are more bars than the axis is pixels wide, each dataset is
+    drawn as a step outline instead, keeping the minimum and maximum of
+    each pixel-wide bucket.
+    """
+    import numpy as np
+    
+    x = np.arange(len(prepared.labels))
+    if len(x) * max(len(prepared.datasets), 1) > max_points:
+        for dataset_label, values in prepared.datasets:
+            step_x, step_y = _finite_points(x.astype(float), values)
+            if len(step_x) > max_points:
+                keep = minmax_indices(step_y, max_points // 2)
+                step_x, step_y = step_x[keep], step_y[keep]
+            ax.step(step_x, step_y, where="mid", label=dataset_label)
+        _set_category_ticks(ax, x, prepared.labels)
+        return
+    
+    width = 0.8 / max(len(prepared.datasets), 1)
+    for j, (dataset_label, values) in enumerate(prepared.datasets):
+        offset = j * width - (len(prepared.datasets) - 1) * width / 2
+        ax.bar(x + offset, values, width, label=dataset_label)
+    _set_category_ticks(ax, x, prepared.labels)
+
+
+def _draw_line_chart(ax, prepared: PreparedChartData, max_points: int) -> None:
+    """Draw one line per dataset, downsampled with LTTB to the axis width in pixels."""
+    for dataset_label, values in prepared.datasets:
+        x, y = _finite_points(prepared.x, values)
+        if len(x) > max_points:
+            keep = lttb_indices(x, y, max_points)
+            x, y = x[keep], y[keep]
+        # Markers only help while individual points can still be told apart
+        ax.plot(x, y, marker='o' if len(x) <= 100 else None, label=dataset_label)
+    
+    if prepared.categorical:
+        _set_category_ticks(ax, prepared.x, prepared.labels)
+
+
+def _draw_pie_chart(ax, prepared: PreparedChartData, max_points: int) -> None:
+    """Draw a pie from the first dataset."""
+    import numpy as np
+    
+    # Use only the first dataset for pie charts
+    if prepared.datasets:
+        values = prepared.datasets[0][1]
+        mask = np.isfinite(values)
+        labels = [label for label, keep in zip(prepared.labels, mask) if keep]
+        ax.pie(values[mask], labels=labels, autopct='%1.1f%%', startangle=90)
+        ax.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle
+
+
+def _draw_scatter_chart(ax, prepared: PreparedChartData, max_points: int) -> None:
+    """Draw one scatter series per dataset.
+    
+    Series longer than the axis width in pixels keep the minimum and maximum
+    of each pixel-wide bucket, and are drawn with small, rasterized markers.
+    """
+    for dataset_label, values in prepared.datasets:
+        x, y = _finite_points(prepared.x, values)
+        dense = len(x) > max_points
+        if dense:
+            keep = minmax_indices(y, max_points)
+            x, y = x[keep], y[keep]
+        
+        if dense:
+            ax.scatter(x, y, s=2, linewidths=0, rasterized=True, label=dataset_label)
+        else:
+            ax.scatter(x, y, label=dataset_label)
+    
+    if prepared.categorical:
+        _set_category_ticks(ax, prepared.x, prepared.labels)
+
+
+CHART_RENDERERS = {
+    "bar": _draw_bar_chart,
+    "line": _draw_line_chart,
+    "pie": _draw_pie_chart,
+    "scatter": _draw_scatter_chart,
+}
+
+
+def validate_charts_data(charts_data: Any) -> Dict[str, Any]:
+    """Check that chart data has the shape the renderers expect.
+    
+    Returns the data with only its "charts" list and raises ValueError
+    describing the first problem found.
+    """
+    if not isinstance(charts_data, dict) or not isinstance(charts_data.get("charts"), list):
+        raise ValueError("chart data must be an object with a 'charts' list")
+    
+    for i, chart in enumerate(charts_data["charts"]):
+        if not isinstance(chart, dict):
+            raise ValueError(f"chart {i+1} is not an object")
+        
+        chart_type = chart.get("type", "bar")
+        if chart_type not in CHART_RENDERERS:
+            raise ValueError(f"chart {i+1} has unsupported type '{chart_type}'")
+        
+        data = chart.get("data")
+        if not isinstance(data, dict):
+            raise ValueError(f"chart {i+1} has no 'data' object")
+        if not isinstance(data.get("labels", []), list) or not isinstance(data.get("datasets", []), list):
+            raise ValueError(f"chart {i+1} must have 'labels' and 'datasets' lists")
+        
+        for j, dataset in enumerate(data.get("datasets", [])):
+            values = dataset.get("values") if isinstance(dataset, dict) else None
+            if not isinstance(values, list) or not all(
+                isinstance(value, (int, float)) and not isinstance(value, bool) for value in values
+            ):
+                raise ValueError(f"dataset {j+1} of chart {i+1} must have a list of numeric values")
+    
+    if not charts_data["charts"]:
+        raise ValueError("chart data contains no charts")
+    
+    return {"charts": charts_data["charts"]}
+
+
+def render_chart_png(chart: Dict[str, Any], title: str, figsize=CHART_FIGSIZE, dpi: int = CHART_DPI) -> bytes:
+    """Render a single chart spec to PNG bytes.
+    
+    Uses the object-oriented matplotlib API with an Agg canvas, so it holds no
+    pyplot global state and is safe to call from worker threads or processes.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    
+    prepared = prepare_chart_data(chart.get("data", {}))
+    
+    renderer = CHART_RENDERERS.get(chart.get("type", "bar"))
+    if renderer:
+        # Never draw more points than the figure is pixels wide
+        renderer(ax, prepared, int(figsize[0] * dpi))
+    
+    ax.set_title(title)
+    ax.set_xlabel(chart.get("x_label", ""))
+    ax.set_ylabel(chart.get("y_label", ""))
+    if len(prepared.datasets) > 1:
+        ax.legend()
+    fig.tight_layout()
+    
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+def _render_chart_timed(chart: Dict[str, Any], title: str) -> Tuple[bytes, float]:
+    """Render a chart and return its PNG bytes with the render time in seconds."""
+    start = time.perf_counter()
+    png_bytes = render_chart_png(chart, title)
+    return png_bytes, time.perf_counter() - start
+
+
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)[\s#]*$")
+_LIST_ITEM_RE = re.compile(r"^\s*(?:[-*+]|(\d+)[.)])\s+(.*)$")
+_RULE_RE = re.compile(r"^(?:-{3,}|\*{3,}|_{3,})$")
+# Inline code spans, whose content is never emphasized
+_INLINE_CODE_RE = re.compile(r"`([^`]+)`")
+
+# Python dunder names such as __init__, which are not bold text
+_DUNDER_RE = re.compile(r"((?<!\w)__\w+__(?!\w))")
+
+# Runs of emphasis delimiters; a run of 1, 2 or 3 means italic, bold or both
+_EMPHASIS_RUN_RE = re.compile(r"\*+|_+")
+_EMPHASIS_TAGS = {1: ("<i>", "</i>"), 2: ("<b>", "</b>"), 3: ("<b><i>", "</i></b>")}
+
+
+def _markdown_block(kind: Optional[str], lines: List[str], ordered: bool) -> Optional[Tuple[str, Any]]:
+    """Return the token for a finished block of lines, or None if there is none."""
+    if not lines:
+        return None
+    if kind == "list":
+        return "list", (ordered, lines)
+    if kind == "table":
+        rows = [
+            [cell.strip() for cell in line.strip().strip("|").split("|")]
+            for line in lines
+            # Skip the |---|:---:| row under the header
+            if not (set(line.strip()) <= set("|:- ") and "-" in line)
+        ]
+        # A stray separator row alone is not a table
+        return ("table", rows) if rows else None
+    return "paragraph", " ".join(line.strip() for line in lines)
+
+
+def tokenize_markdown(content: str) -> Iterator[Tuple[str, Any]]:
+    """Split markdown into block tokens in a single pass over its lines.
+    
+    Yields ("heading", (level, text)), ("paragraph", text),
+    ("list", (ordered, items)), ("table", rows) and ("code", (language,
+    text)). Inline markup is left in the text; see markdown_inline_to_markup.
+    Paragraphs are cut every PDF_MAX_PARAGRAPH_LINES lines.
+    """
+    kind: Optional[str] = None
+    lines: List[str] = []
+    ordered = False
+    language = ""
+    
+    for line in content.splitlines():
+        stripped = line.strip()
+        
+        # Inside a fenced code block everything up to the closing fence is code
+        if kind == "code":
+            if stripped.startswith("```"):
+                yield "code", (language, "\n".join(lines))
+                kind, lines = None, []
+            else:
+                lines.append(line)
+            continue
+        
+        heading = _HEADING_RE.match(stripped)
+        if stripped.startswith("```") or heading or not stripped or _RULE_RE.match(stripped):
+            token = _markdown_block(kind, lines, ordered)
+            if token:
+                yield token
+            kind, lines = None, []
+            if stripped.startswith("```"):
+                kind, language = "code", stripped[3:].strip().lower()
+            elif heading:
+                yield "heading", (len(heading.group(1)), heading.group(2))
+            continue
+        
+        item = _LIST_ITEM_RE.match(line)
+        if stripped.startswith("|"):
+            line_kind = "table"
+        elif item:
+            line_kind = "list"
+        elif kind == "list" and line[:1].isspace():
+            # An indented line continues the previous list item
+            lines[-1] += " " + stripped
+            continue
+        else:
+            line_kind = "paragraph"
+        
+        starts_block = (
+            line_kind != kind
+            or (kind == "paragraph" and len(lines) >= PDF_MAX_PARAGRAPH_LINES)
+            or (kind == "list" and bool(item.group(1)) != ordered)
+        )
+        if starts_block:
+            token = _markdown_block(kind, lines, ordered)
+            if token:
+                yield token
+            kind, lines = line_kind, []
+            ordered = bool(item and item.group(1))
+        lines.append(item.group(2) if line_kind == "list" else line)
+    
+    if kind == "code":
+        yield "code", (language, "\n".join(lines))
+    else:
+        token = _markdown_block(kind, lines, ordered)
+        if token:
+            yield token
+
+
+def _emphasis_to_markup(text: str) -> str:
+    """Convert */_ emphasis in escaped text to markup, outermost spans first.
+    
+    A run opens a span only at the start of a word (not after a letter or
+    digit, and before a non-space) and is closed by the next identical run
+    at the end of a word, so 2*3*4 and snake_case stay as they are. The
+    text inside a span is converted in turn, which handles nesting such as
+    *a **b** c*.
+    """
+    runs = list(_EMPHASIS_RUN_RE.finditer(text))
+    parts = []
+    pos = 0
+    i = 0
+    
+    while i < len(runs):
+        opener = runs[i]
+        i += 1
+        delimiter = opener.group()
+        before = text[opener.start() - 1] if opener.start() else " "
+        after = text[opener.end()] if opener.end() < len(text) else " "
+        if len(delimiter) > 3 or before.isalnum() or after.isspace():
+            continue
+        
+        for j in range(i, len(runs)):
+            closer = runs[j]
+            before = text[closer.start() - 1]
+            after = text[closer.end()] if closer.end() < len(text) else " "
+            if closer.group() == delimiter and not before.isspace() and not after.isalnum():
+                start_tag, end_tag = _EMPHASIS_TAGS[len(delimiter)]
+                parts.append(text[pos:opener.start()])
+                parts.append(start_tag + _emphasis_to_markup(text[opener.end():closer.start()]) + end_tag)
+                pos = closer.end()
+                i = j + 1
+                break
+    
+    parts.append(text[pos:])
+    return "".join(parts)
+
+
+def markdown_inline_to_markup(text: str, code_font: str = "Courier") -> str:
+    """Convert inline markdown (bold, italics, code) to reportlab paragraph markup.
+    
+    XML special characters are escaped first, so arbitrary text is safe to
+    pass to Paragraph. Code spans and dunder names are kept literally.
+    """
+    parts = _INLINE_CODE_RE.split(xml_escape(text))
+    markup = []
+    for index, part in enumerate(parts):
+        if index % 2:
+            markup.append(f'<font face="{code_font}">{part}</font>')
+            continue
+        for piece_index, piece in enumerate(_DUNDER_RE.split(part)):
+            markup.append(piece if piece_index % 2 else _emphasis_to_markup(piece))
+    return "".join(markup)
+
+
+class ReportTemplate:
+    """Styles, page layout and fonts for PDF reports, built once and reused.
+    
+    font_paths maps font names to TrueType files to register with reportlab.
+    Frames keep layout state while a document is built, so new_document
+    creates the page template for each document from the stored geometry.
+    """
+    
+    def __init__(self, pagesize: Optional[Tuple[float, float]] = None, margin: float = 72.0,
+                 font_name: str = "Helvetica", bold_font_name: str = "Helvetica-Bold",
+                 code_font_name: str = "Courier", font_paths: Optional[Dict[str, str]] = None):
+        """Register fonts and build the paragraph and table styles."""
+        from reportlab.lib import colors
+        from reportlab.lib.pagesizes import letter
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.platypus import TableStyle
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        
+        for name, path in (font_paths or {}).items():
+            if name not in pdfmetrics.getRegisteredFontNames():
+                pdfmetrics.registerFont(TTFont(name, path))
+        
+        self.pagesize = pagesize or letter
+        self.margin = margin
+        self.code_font_name = code_font_name
+        styles = getSampleStyleSheet()
+        
+        # Create custom styles
+        self.title_style = ParagraphStyle(
+            'TitleStyle',
+            parent=styles['Heading1'],
+            fontName=bold_font_name,
+            fontSize=18,
+            spaceAfter=12
+        )
+        
+        self.heading_style = ParagraphStyle(
+            'HeadingStyle',
+            parent=styles['Heading2'],
+            fontName=bold_font_name,
+            fontSize=14,
+            spaceAfter=10
+        )
+        
+        self.subheading_style = ParagraphStyle(
+            'SubheadingStyle',
+            parent=styles['Heading3'],
+            fontName=bold_font_name,
+            fontSize=12,
+            spaceAfter=8
+        )
+        
+        self.normal_style = ParagraphStyle(
+            'NormalStyle',
+            parent=styles['Normal'],
+            fontName=font_name,
+            fontSize=10,
+            spaceAfter=8
+        )
+        
+        self.list_style = ParagraphStyle(
+            'ListStyle',
+            parent=self.normal_style,
+            spaceAfter=2
+        )
+        
+        self.code_style = ParagraphStyle(
+            'CodeStyle',
+            parent=styles['Code'],
+            fontName=code_font_name,
+            fontSize=8,
+            leading=10,
+            spaceAfter=8
+        )
+        
+        self.table_cell_style = ParagraphStyle(
+            'TableCellStyle',
+            parent=self.normal_style,
+            fontSize=9,
+            spaceAfter=0
+        )
+        
+        self.table_style = TableStyle([
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+            ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ])
+    
+    @property
+    def frame_width(self) -> float:
+        """Return the width of the text frame in points."""
+        return self.pagesize[0] - 2 * self.margin
+    
+    @property
+    def frame_height(self) -> float:
+        """Return the height of the text frame in points."""
+        return self.pagesize[1] - 2 * self.margin
+    
+    def new_document(self, filename: str, compact: bool = False):
+        """Return a document template for filename laid out with this template."""
+        from reportlab.platypus import BaseDocTemplate, Frame, PageTemplate
+        
+        # pageCompression=None keeps reportlab's configured default
+        doc = BaseDocTemplate(
+            filename,
+            pagesize=self.pagesize,
+            leftMargin=self.margin,
+            rightMargin=self.margin,
+            topMargin=self.margin,
+            bottomMargin=self.margin,
+            pageCompression=1 if compact else None
+        )
+        frame = Frame(doc.leftMargin, doc.bottomMargin, doc.width, doc.height, id="normal")
+        doc.addPageTemplates([PageTemplate(id="Page", frames=[frame], pagesize=self.pagesize)])
+        return doc
+
+
+class _FlowableStream(list):
+    """A story for BaseDocTemplate.build that pulls its flowables from an iterator.
+    
+    build() only looks at the front of its story (and len() of it), so
+    keeping lookahead flowables buffered is enough for keepWithNext, while
+    the rest are only created once layout reaches them.
+    """
+    
+    def __init__(self, source: Iterator[Any], lookahead: int):
+        """Initialize an empty story that is filled from source."""
+        super().__init__()
+        self._source: Optional[Iterator[Any]] = source
+        self._lookahead = lookahead
+    
+    def __len__(self) -> int:
+        """Buffer up to lookahead more flowables, then return the buffered count."""
+        while self._source is not None and super().__len__() <= self._lookahead:
+            try:
+                self.append(next(self._source))
+            except StopIteration:
+                self._source = None
+        return super().__len__()
+
+
+class PDFReportBuilder:
+    """Lays out a PDF report page by page as its content is produced.
+    
+    Content added to the builder is only turned into flowables once
+    reportlab's BaseDocTemplate.build reaches it: the story passed to
+    build() is a _FlowableStream that tokenizes markdown on demand, so laid
+    out text is released as pages are completed instead of a whole story
+    being held in memory. A few flowables are buffered so that keepWithNext
+    headings still see what follows.
+    
+    Chart images are decoded only when their page is drawn. In compact mode
+    identical charts share one decoded image and page streams are always
+    compressed, whatever reportlab's default.
+    """
+    
+    # Flowables buffered ahead of layout for keepWithNext lookahead
+    LOOKAHEAD = 4
+    
+    # Blocks searched for a title heading before falling back to "Report"
+    TITLE_SEARCH_TOKENS = 20
+    
+    def __init__(self, filename: str, template: Optional[ReportTemplate] = None, compact: bool = False):
+        """Initialize the builder for filename using template (a new default one if omitted)."""
+        self.filename = filename
+        self.template = template or ReportTemplate()
+        self.compact = compact
+        self.doc = self.template.new_document(filename, compact)
+        self._output: Optional[str] = None
+        self._parts: List[Iterable[Any]] = []
+        self._images: Dict[str, Any] = {}
+    
+    def start(self, filename: Optional[str] = None) -> None:
+        """Write the PDF to filename instead of self.filename if given."""
+        self._output = filename
+    
+    def add(self, *flowables: Any) -> None:
+        """Append flowables to the report."""
+        self._parts.append(flowables)
+    
+    def _markup(self, text: str) -> str:
+        """Convert inline markdown to paragraph markup."""
+        return markdown_inline_to_markup(text, self.template.code_font_name)
+    
+    def _title_flowables(self, title: str) -> List[Any]:
+        """Return the flowables of the report title."""
+        from reportlab.platypus import Paragraph, Spacer
+        from reportlab.lib.units import inch
+        
+        return [Paragraph(self._markup(title), self.template.title_style), Spacer(1, 0.25*inch)]
+    
+    def _heading_flowables(self, heading: str, level: int = 2, space_before: float = 0.2) -> List[Any]:
+        """Return the flowables of a section heading after space_before inches of space."""
+        from reportlab.platypus import Paragraph, Spacer
+        from reportlab.lib.units import inch
+        
+        style = self.template.heading_style if level <= 2 else self.template.subheading_style
+        return [Spacer(1, space_before*inch), Paragraph(self._markup(heading), style)]
+    
+    def _paragraph_flowables(self, text: str) -> List[Any]:
+        """Return the flowables of a paragraph of body text."""
+        from reportlab.platypus import Paragraph
+        
+        return [Paragraph(self._markup(text), self.template.normal_style)]
+    
+    def _list_flowables(self, items: List[str], ordered: bool = False) -> List[Any]:
+        """Return the flowables of a bulleted or numbered list."""
+        from reportlab.platypus import ListFlowable, ListItem, Paragraph
+        
+        return [ListFlowable(
+            [ListItem(Paragraph(self._markup(item), self.template.list_style)) for item in items],
+            bulletType='1' if ordered else 'bullet',
+            spaceAfter=8
+        )]
+    
+    def _table_flowables(self, rows: List[List[str]]) -> List[Any]:
+        """Return the flowables of a table whose first row is the header, with equal column widths."""
+        from reportlab.platypus import Paragraph, Table
+        
+        if not rows:
+            return []
+        
+        columns = max(len(row) for row in rows)
+        column_width = self.template.frame_width / columns
+        style = self.template.table_cell_style
+        data = [[Paragraph(self._markup(cell), style) for cell in row + [""] * (columns - len(row))] for row in rows]
+        
+        # The header is repeated on every page, so it is only repeated while it leaves room for the rows
+        header_height = max(cell.wrap(column_width, self.template.frame_height)[1] for cell in data[0])
+        repeat_header = header_height <= self.template.frame_height * PDF_TABLE_HEADER_FRACTION
+        
+        # Rows taller than a page are split between pages instead of failing the layout
+        return [Table(
+            data,
+            colWidths=[column_width] * columns,
+            repeatRows=1 if repeat_header else 0,
+            splitInRow=1,
+            style=self.template.table_style,
+            hAlign="LEFT",
+            spaceAfter=8
+        )]
+    
+    def _code_flowables(self, code: str) -> List[Any]:
+        """Return the flowables of a preformatted code block."""
+        from reportlab.platypus import Preformatted
+        
+        return [Preformatted(code, self.template.code_style, maxLineLength=PDF_CODE_LINE_LENGTH, newLineChars="")]
+    
+    def _image_flowables(self, artifact: ChartArtifact, width: float = 6.0, height: float = 3.5) -> List[Any]:
+        """Return the flowables of a chart image of width by height inches."""
+        from reportlab.platypus import Spacer
+        from reportlab.lib.units import inch
+        
+        image_class = _lazy_image_class()
+        readers = self._images if self.compact else None
+        return [Spacer(1, 0.2*inch), image_class(artifact, width*inch, height*inch, readers)]
+    
+    def add_title(self, title: str) -> None:
+        """Add the report title."""
+        self.add(*self._title_flowables(title))
+    
+    def add_heading(self, heading: str, level: int = 2, space_before: float = 0.2) -> None:
+        """Add a section heading after space_before inches of space."""
+        self.add(*self._heading_flowables(heading, level, space_before))
+    
+    def add_paragraph(self, text: str) -> None:
+        """Add a paragraph of body text."""
+        self.add(*self._paragraph_flowables(text))
+    
+    def add_list(self, items: List[str], ordered: bool = False) -> None:
+        """Add a bulleted or numbered list."""
+        self.add(*self._list_flowables(items, ordered))
+    
+    def add_table(self, rows: List[List[str]]) -> None:
+        """Add a table whose first row is the header, with equal column widths."""
+        self.add(*self._table_flowables(rows))
+    
+    def add_code(self, code: str) -> None:
+        """Add a preformatted code block."""
+        self.add(*self._code_flowables(code))
+    
+    def add_image(self, artifact: ChartArtifact, width: float = 6.0, height: float = 3.5) -> None:
+        """Add a chart image of width by height inches."""
+        self.add(*self._image_flowables(artifact, width, height))
+    
+    def add_markdown(self, content: str) -> None:
+        """Add markdown content, using its first level-one heading as the title.
+        
+        Blocks before that heading follow the title. If the content opens
+        without one (within TITLE_SEARCH_TOKENS blocks), the title is
+        "Report". JSON code blocks are left out, since they hold the chart
+        data. The content is tokenized while the PDF is laid out.
+        """
+        self._parts.append(self._markdown_flowables(content))
+    
+    def _markdown_flowables(self, content: str) -> Iterator[Any]:
+        """Yield the flowables of markdown content; see add_markdown."""
+        title_seen = False
+        before_title: List[Tuple[str, Any]] = []
+        
+        for token in tokenize_markdown(content):
+            if not title_seen:
+                kind, value = token
+                if kind == "heading" and value[0] == 1:
+                    yield from self._title_flowables(value[1])
+                    token = None
+                elif kind != "heading" and len(before_title) < self.TITLE_SEARCH_TOKENS:
+                    before_title.append(token)
+                    continue
+                else:
+                    yield from self._title_flowables("Report")
+                
+                title_seen = True
+                for pending in before_title:
+                    yield from self._token_flowables(*pending)
+                before_title = []
+            
+            if token:
+                yield from self._token_flowables(*token)
+        
+        if not title_seen:
+            yield from self._title_flowables("Report")
+            for pending in before_title:
+                yield from self._token_flowables(*pending)
+    
+    def _token_flowables(self, kind: str, value: Any) -> List[Any]:
+        """Return the flowables of one token produced by tokenize_markdown."""
+        if kind == "heading":
+            return self._heading_flowables(value[1], value[0])
+        if kind == "paragraph":
+            return self._paragraph_flowables(value)
+        if kind == "list":
+            return self._list_flowables(value[1], ordered=value[0])
+        if kind == "table":
+            return self._table_flowables(value)
+        if kind == "code":
+            language, code = value
+            if language != "json" and not code.lstrip().startswith("{"):
+                return self._code_flowables(code)
+        return []
+    
+    def finish(self) -> int:
+        """Lay out all added content, save the PDF and return its page count."""
+        story = _FlowableStream(itertools.chain.from_iterable(self._parts), self.LOOKAHEAD)
+        try:
+            self.doc.build(story, filename=self._output)
+        finally:
+            self._parts = []
+            self._images.clear()
+        return self.doc.page
+
+
+_LAZY_IMAGE_CLASS = None
+
+
+def _lazy_image_class():
+    """Return the LazyImage flowable class, defining it on first use.
+    
+    The class derives from reportlab's Flowable, so it is created here
+    rather than at import time to keep reportlab out of startup.
+    """
+    global _LAZY_IMAGE_CLASS
+    if _LAZY_IMAGE_CLASS is not None:
+        return _LAZY_IMAGE_CLASS
+    
+    from reportlab.platypus import Flowable
+    from reportlab.lib.utils import ImageReader
+    
+    class LazyImage(Flowable):
+        """A chart image whose PNG is decoded only when its page is drawn.
+        
+        When readers is a dict, decoded images are shared through it by
+        artifact key; otherwise each decoded image is dropped after drawing.
+        """
+        
+        def __init__(self, artifact: ChartArtifact, width: float, height: float,
+                     readers: Optional[Dict[str, Any]] = None):
+            """Initialize the image with its drawing size in points."""
+            Flowable.__init__(self)
+            self.artifact = artifact
+            self.width = width
+            self.height = height
+            self.hAlign = "CENTER"
+            self._readers = readers
+        
+        def wrap(self, available_width, available_height):
+            """Return the drawing size."""
+            return self.width, self.height
+        
+        def draw(self):
+            """Decode the PNG and draw it."""
+            if self._readers is None:
+                reader = ImageReader(self.artifact.open())
+            else:
+                reader = self._readers.get(self.artifact.key)
+                if reader is None:
+                    reader = self._readers[self.artifact.key] = ImageReader(self.artifact.open())
+            self.canv.drawImage(reader, 0, 0, self.width, self.height, mask="auto")
+    
+    _LAZY_IMAGE_CLASS = LazyImage
+    return _LAZY_IMAGE_CLASS
+
+
+def parse_plan(content: str) -> Tuple[str, List[Dict[str, str]]]:
+    """Parse a planner response into a report title and its sections.
+    
+    Each section is a {"heading": ..., "task": ...} dict. At most
+    PLANNER_MAX_SECTIONS sections are kept. Raises ValueError if the
+    response holds no usable plan.
+    """
+    json_match = re.search(r'```json\s*(.*?)\s*```', content, re.DOTALL) or re.search(r'\{.*\}', content, re.DOTALL)
+    if not json_match:
+        raise ValueError("no JSON plan found in the response")
+    
+    plan = json.loads(json_match.group(1) if json_match.groups() else json_match.group(0))
+    if not isinstance(plan, dict) or not isinstance(plan.get("sections"), list):
+        raise ValueError("plan must be an object with a 'sections' list")
+    
+    sections = []
+    for section in plan["sections"][:PLANNER_MAX_SECTIONS]:
+        if not isinstance(section, dict) or not section.get("heading") or not section.get("task"):
+            raise ValueError("every section needs a 'heading' and a 'task'")
+        sections.append({"heading": str(section["heading"]).strip(), "task": str(section["task"]).strip()})
+    
+    if not sections:
+        raise ValueError("plan contains no sections")
+    
+    return str(plan.get("title") or "Report").strip(), sections
 
 
 class EnhancedLLMAgent:
     """An enhanced agent with PDF generation and visualization capabilities."""
     
-    def __init__(self, openai_api_key: str, openai_base_url: Optional[str] = None):
-        """Initialize the agent with the LLM."""
+    def __init__(self, openai_api_key: str, openai_base_url: Optional[str] = None,
+                 save_chart_files: bool = True, render_workers: Optional[int] = None,
+                 render_executor: str = "thread", response_cache: Optional[LLMResponseCache] = None,
+                 structured_output: bool = False, repair_charts: bool = True,
+                 output_manager: Optional[OutputManager] = None,
+                 metrics_sink: Optional[MetricsSink] = None, llm: Any = None,
+                 client_factory: Optional[LLMClientFactory] = None, max_attempts: int = LLM_MAX_ATTEMPTS,
+                 compact_pdf: bool = False, planner: bool = False, planner_concurrency: int = 4,
+                 chart_cache: Optional[ChartDiskCache] = None):
+        """Initialize the agent with the LLM.
+        
+        When save_chart_files is False, charts are rendered in memory only and
+        handed to the PDF builder without being written to disk. Charts of a
+        report are rendered in parallel on a "thread" or "process" pool with
+        render_workers workers (defaults to the number of CPUs). Passing a
+        response_cache makes repeated prompts skip the LLM round trip.
+        
+        With structured_output, execute() asks for the prose and the chart
+        data as separate fields of a JSON-schema response instead of parsing
+        a JSON block out of free text. When chart data is missing or invalid,
+        repair_charts allows one short follow-up call asking only for it.
+        Files of each run are written to their own directory provided by
+        output_manager. Every result carries a "metrics" dict, which is also
+        passed to metrics_sink when one is given.
+        
+        llm replaces the default ChatOpenAI client, e.g. with a
+        ReplayChatModel for offline runs and benchmarks. Otherwise the client
+        comes from client_factory (the process-wide shared_client_factory by
+        default), which shares HTTP connection pools and rate limits between
+        agents. Transient LLM errors are retried up to max_attempts times.
+        
+        compact_pdf makes reports smaller by compressing pages and sharing
+        identical chart images; see PDFReportBuilder.
+        
+        With planner, execute() and aexecute() split each instruction into
+        sections that are written by up to planner_concurrency concurrent
+        LLM calls; see aexecute_planned.
+        
+        With a chart_cache, rendered charts are also kept on disk, so a
+        re-run only renders the charts that are new or changed.
+        """
+        if render_executor not in ("thread", "process"):
+            raise ValueError(f"Unknown render executor: {render_executor}")
+        if planner_concurrency < 1:
+            raise ValueError("planner_concurrency must be at least 1")
+        
         self.api_key = openai_api_key
         self.base_url = openai_base_url
+        self.model = getattr(llm, "model_name", "gpt-4o")
+        self.temperature = getattr(llm, "temperature", 0)
+        self.response_cache = response_cache
+        self.structured_output = structured_output
+        self.repair_charts = repair_charts
+        self.output_manager = output_manager or OutputManager()
+        self.metrics_sink = metrics_sink
+        self.save_chart_files = save_chart_files
+        self.compact_pdf = compact_pdf
+        self.planner = planner
+        self.planner_concurrency = planner_concurrency
+        self._report_template: Optional[ReportTemplate] = None
+        self._report_template_lock = threading.Lock()
+        self.render_workers = render_workers or os.cpu_count() or 1
+        self.render_executor = render_executor
+        self._render_pool: Optional[Executor] = None
+        self._render_pool_lock = threading.Lock()
+        self._inflight_renders: Dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
+        
+        self.max_attempts = max(1, max_attempts)
         
         # Initialize the LLM
-        self.llm = ChatOpenAI(
-            model="gpt-4o",
-            temperature=0,
-            max_tokens=None,
-            timeout=None,
-            max_retries=2,
-            base_url=self.base_url,
-            api_key=self.api_key,
-        )
+        if llm is not None:
+            self.client_factory = client_factory
+            self.llm = llm
+        else:
+            self.client_factory = client_factory or shared_client_factory
+            self.llm = self.client_factory.get_llm(self.model, self.temperature, self.base_url, self.api_key)
+        self.rate_limiter = self.client_factory.rate_limiter if self.client_factory else None
+        
+        # Rendered charts are shared between execute() and the PDF step
+        self.chart_store = ChartArtifactStore(disk_cache=chart_cache)
         
         logger.info("EnhancedLLMAgent initialized successfully")
     
     def execute(self, instruction: str) -> Dict[str, Any]:
         """Execute the given instruction using the LLM."""
+        if self.planner:
+            return self.execute_planned(instruction)
+        
         logger.info(f"Executing instruction: {instruction}")
+        metrics = RunMetrics(track_memory=True)
         
         try:
-            # Check if visualization is requested
-            needs_visualization = any(keyword in instruction.lower() for keyword in 
-                                     ["chart", "graph", "plot", "figure", "visualization", "visualize", "diagram"])
+            with metrics.stage("prompt"):
+                needs_visualization, needs_pdf = self._analyze_instruction(instruction)
+                structured = self.structured_output and needs_visualization
+                prompt = self._build_prompt(instruction, needs_visualization, inline_charts=not structured)
+            
+            # Get response from the LLM
+            charts_data = None
+            with metrics.stage("llm"):
+                if structured:
+                    content, charts_data = self._invoke_structured(prompt, metrics)
+                    if content is None:
+                        # Nothing usable came back; ask again for free text with inline charts
+                        content = self._invoke_llm(self._build_prompt(instruction, needs_visualization), metrics)
+                else:
+                    content = self._invoke_llm(prompt, metrics)
             
-            # Check if PDF is requested
-            needs_pdf = any(keyword in instruction.lower() for keyword in 
-                           ["pdf", "document", "report", "export"])
+            result = self._process_response(content, needs_visualization, needs_pdf, charts_data, metrics)
             
-            # Create a prompt that instructs the LLM to handle the task
-            prompt = f"""
-            I need you to help me with the following task:
+        except Exception as e:
+            logger.error(f"Error executing instruction: {str(e)}")
+            result = {"text_content": f"Error: {str(e)}", "charts_data": None, "pdf_path": None, "error": str(e)}
+        
+        return self._finish_run(result, metrics)
+    
+    async def aexecute(self, instruction: str) -> Dict[str, Any]:
+        """Execute the given instruction without blocking the event loop.
+        
+        The LLM call is awaited and the CPU-bound chart and PDF work runs on
+        the loop's executor, so many instructions can be in flight at once.
+        """
+        if self.planner:
+            return await self.aexecute_planned(instruction)
+        
+        logger.info(f"Executing instruction: {instruction}")
+        metrics = RunMetrics(track_memory=True)
+        
+        try:
+            with metrics.stage("prompt"):
+                needs_visualization, needs_pdf = self._analyze_instruction(instruction)
+                structured = self.structured_output and needs_visualization
+                prompt = self._build_prompt(instruction, needs_visualization, inline_charts=not structured)
             
-            {instruction}
+            # Get response from the LLM
+            charts_data = None
+            with metrics.stage("llm"):
+                if structured:
+                    content, charts_data = await self._ainvoke_structured(prompt, metrics)
+                    if content is None:
+                        # Nothing usable came back; ask again for free text with inline charts
+                        content = await self._ainvoke_llm(self._build_prompt(instruction, needs_visualization), metrics)
+                else:
+                    content = await self._ainvoke_llm(prompt, metrics)
             
-            Please approach this task step by step:
-            1. Think about what information is needed
-            2. Consider what you already know about this topic
-            3. Provide a detailed response that addresses the task
-            """
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                None,
+                self._process_response,
+                content,
+                needs_visualization,
+                needs_pdf,
+                charts_data,
+                metrics
+            )
             
-            # Add visualization instructions if needed
-            if needs_visualization:
-                prompt += """
-                4. Include data for visualizations in the following JSON format:
-                
-                ```json
+        except Exception as e:
+            logger.error(f"Error executing instruction: {str(e)}")
+            result = {"text_content": f"Error: {str(e)}", "charts_data": None, "pdf_path": None, "error": str(e)}
+        
+        return self._finish_run(result, metrics)
+    
+    async def abatch_execute(self, instructions: List[str], concurrency: int = 4) -> List[Dict[str, Any]]:
+        """Execute several instructions concurrently, at most concurrency at a time.
+        
+        Results are returned in the same order as the instructions.
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def run_one(instruction: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.aexecute(instruction)
+        
+        return await asyncio.gather(*(run_one(instruction) for instruction in instructions))
+    
+    async def aexecute_planned(self, instruction: str) -> Dict[str, Any]:
+        """Execute the instruction as independent sections written concurrently.
+        
+        A short planning call splits the instruction into sections (one per
+        indicator or topic), each section is generated by its own smaller
+        LLM call, and the sections and their charts are merged into the
+        same result dict as aexecute(). A section that fails is retried on
+        its own; if it still fails, the report notes the gap and the result
+        lists it under "failed_sections".
+        """
+        logger.info(f"Executing planned instruction: {instruction}")
+        metrics = RunMetrics(track_memory=True)
+        
+        try:
+            with metrics.stage("prompt"):
+                needs_visualization, needs_pdf = self._analyze_instruction(instruction)
+            
+            with metrics.stage("plan"):
+                title, sections = await self._aplan(instruction, metrics)
+            
+            semaphore = asyncio.Semaphore(self.planner_concurrency)
+            
+            async def run_section(section: Dict[str, str]) -> Tuple[Optional[str], List[Dict[str, Any]], Optional[str]]:
+                async with semaphore:
+                    return await self._aexecute_section(instruction, section, needs_visualization, metrics)
+            
+            # Get the sections from the LLM
+            with metrics.stage("llm"):
+                outcomes = await asyncio.gather(*(run_section(section) for section in sections))
+            
+            # Merge the sections in plan order
+            parts = [f"# {title}"]
+            charts: List[Dict[str, Any]] = []
+            failed_sections = []
+            for section, (text, section_charts, error) in zip(sections, outcomes):
+                if error is not None:
+                    failed_sections.append({"heading": section["heading"], "error": error})
+                    parts.append(f"## {section['heading']}\n\n*This section could not be generated: {error}*")
+                else:
+                    parts.append(text)
+                    charts.extend(section_charts)
+            
+            if len(failed_sections) == len(sections):
+                raise RuntimeError(f"All {len(sections)} sections failed: {failed_sections[0]['error']}")
+            
+            # Without any section charts, _process_response falls back to repairing them
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                None,
+                self._process_response,
+                "\n\n".join(parts),
+                needs_visualization,
+                needs_pdf,
+                {"charts": charts} if charts else None,
+                metrics
+            )
+            result["failed_sections"] = failed_sections
+            
+        except Exception as e:
+            logger.error(f"Error executing instruction: {str(e)}")
+            result = {"text_content": f"Error: {str(e)}", "charts_data": None, "pdf_path": None, "error": str(e)}
+        
+        return self._finish_run(result, metrics)
+    
+    def run_async(self, coroutine: Awaitable[Any]) -> Any:
+        """Run coroutine in a new event loop, closing the loop's HTTP pool before it ends."""
+        async def run():
+            try:
+                return await coroutine
+            finally:
+                if self.client_factory is not None:
+                    await self.client_factory.aclose_loop()
+        
+        return asyncio.run(run())
+    
+    def execute_planned(self, instruction: str) -> Dict[str, Any]:
+        """Synchronous wrapper around aexecute_planned."""
+        return self.run_async(self.aexecute_planned(instruction))
+    
+    async def _aplan(self, instruction: str, metrics: RunMetrics) -> Tuple[str, List[Dict[str, str]]]:
+        """Split the instruction into a report title and independent sections.
+        
+        Falls back to a single section covering the whole instruction when
+        the planning call fails or returns no usable plan.
+        """
+        prompt = f"""
+        Plan a report for the task below. Split it into at most {PLANNER_MAX_SECTIONS} sections
+        that can be researched and written independently of each other, one per
+        indicator, topic or part of the analysis. Do not write the report itself.
+        
+        Task: {instruction}
+        
+        Return only JSON in the following format:
+        
+        ```json
+        {{
+            "title": "Report Title",
+            "sections": [
                 {{
-                    "charts": [
-                        {{
-                            "title": "Chart Title",
-                            "type": "line|bar|pie|scatter",
-                            "x_label": "X-Axis Label",
-                            "y_label": "Y-Axis Label",
-                            "data": {{
-                                "labels": ["Label1", "Label2", "Label3", ...],
-                                "datasets": [
-                                    {{
-                                        "label": "Dataset Label",
-                                        "values": [value1, value2, value3, ...]
-                                    }},
-                                    ...
-                                ]
-                            }}
-                        }},
-                        ...
-                    ]
+                    "heading": "Section Heading",
+                    "task": "What this section must cover"
                 }}
-                ```
-                
-                Provide realistic and representative data based on your knowledge of the topic.
-                """
+            ]
+        }}
+        ```
+        """
+        
+        try:
+            return parse_plan(await self._ainvoke_llm(prompt, metrics))
+        except Exception as e:
+            logger.warning(f"Could not plan the instruction, running it as one section: {str(e)}")
+            return "Report", [{"heading": "Analysis", "task": instruction}]
+    
+    async def _aexecute_section(self, instruction: str, section: Dict[str, str], needs_visualization: bool,
+                                metrics: RunMetrics) -> Tuple[Optional[str], List[Dict[str, Any]], Optional[str]]:
+        """Generate one planned section, retrying it on its own if it fails.
+        
+        Returns the section markdown (without its chart block), the section's
+        charts and None, or (None, [], error) once every attempt failed.
+        """
+        heading = section["heading"]
+        section_instruction = f"""This is one section of a larger report on the following task: {instruction}
+        
+        Write only the section "{heading}", covering: {section['task']}
+        Start with the markdown heading "## {heading}" and do not add an introduction
+        or conclusion for the whole report."""
+        prompt = self._build_prompt(section_instruction, needs_visualization)
+        
+        error = None
+        for attempt in range(PLANNER_SECTION_ATTEMPTS):
+            try:
+                content = await self._ainvoke_llm(prompt, metrics)
+                break
+            except Exception as e:
+                error = str(e)
+                logger.warning(f"Section '{heading}' failed on attempt {attempt+1}: {error}")
+        else:
+            return None, [], error
+        
+        # Section charts are merged; invalid ones are skipped rather than repaired per section
+        charts = []
+        json_match = re.search(r'```json\s*(.*?)\s*```', content, re.DOTALL)
+        if json_match:
+            try:
+                charts = validate_charts_data(json.loads(json_match.group(1)))["charts"]
+            except ValueError as e:
+                logger.warning(f"Invalid chart data in section '{heading}': {str(e)}")
+        
+        text = re.sub(r'```json\s*.*?\s*```', '', content, flags=re.DOTALL).strip()
+        if not text.startswith("## "):
+            text = f"## {heading}\n\n{text}"
+        return text, charts, None
+    
+    def batch_execute(self, instructions: List[str], concurrency: int = 4) -> List[Dict[str, Any]]:
+        """Synchronous wrapper around abatch_execute."""
+        return self.run_async(self.abatch_execute(instructions, concurrency))
+    
+    def execute_stream(self, instruction: str, on_token: Optional[Callable[[str], None]] = None,
+                       on_section: Optional[Callable[[Optional[str], str], None]] = None,
+                       reference: Optional[str] = None) -> Dict[str, Any]:
+        """Execute the instruction while streaming the LLM output.
+        
+        Each token is passed to on_token as it arrives and each finished
+        "## " section to on_section. Chart rendering starts as soon as the
+        JSON chart block is complete, overlapping with the rest of the
+        generation. Returns the same result dict as execute(); chart data is
+        always read from the streamed text, even with structured_output.
+        reference is an earlier report to start from; see _build_prompt.
+        """
+        logger.info(f"Executing instruction (streaming): {instruction}")
+        metrics = RunMetrics(track_memory=True)
+        scheduled: List[Tuple[str, str, Any]] = []
+        
+        try:
+            with metrics.stage("prompt"):
+                needs_visualization, needs_pdf = self._analyze_instruction(instruction)
+                prompt = self._build_prompt(instruction, needs_visualization, reference=reference)
+            parser = StreamingResponseParser()
             
-            # Get response from the LLM
-            response = self.llm.invoke(prompt)
+            def handle_events(events: List[Tuple[str, Any]]) -> None:
+                for kind, payload in events:
+                    if kind == "section" and on_section:
+                        on_section(*payload)
+                    elif kind == "charts" and needs_visualization:
+                        # Start rendering before the model finishes its prose
+                        scheduled.extend(self._schedule_charts(payload))
+            
+            cache_key = self._cache_key(prompt)
+            content = self._cached_response(cache_key, metrics)
+            
+            if content is not None:
+                if on_token:
+                    on_token(content)
+                handle_events(parser.feed(content))
+            else:
+                chunks = []
+                stream_started = time.perf_counter()
+                metrics.add("llm_calls")
+                for chunk in self._stream_llm(prompt):
+                    metrics.record_usage(chunk)
+                    token = chunk.content
+                    if not token:
+                        continue
+                    if not chunks:
+                        metrics.record_stage("llm_first_token", time.perf_counter() - stream_started)
+                    chunks.append(token)
+                    if on_token:
+                        on_token(token)
+                    handle_events(parser.feed(token))
+                metrics.record_stage("llm", time.perf_counter() - stream_started)
+                content = "".join(chunks)
+                self._store_response(cache_key, content)
+            
+            handle_events(parser.close())
+            
+            # The parser already found and validated the chart block, even after an example block
+            result = self._process_response(
+                content,
+                needs_visualization,
+                needs_pdf,
+                charts_data=parser.charts_data,
+                metrics=metrics,
+                scheduled=scheduled
+            )
+            
+        except Exception as e:
+            logger.error(f"Error executing instruction: {str(e)}")
+            result = {"text_content": f"Error: {str(e)}", "charts_data": None, "pdf_path": None, "error": str(e)}
+        
+        finally:
+            self._release_renders(scheduled)
+        
+        return self._finish_run(result, metrics)
+    
+    def _finish_run(self, result: Dict[str, Any], metrics: RunMetrics) -> Dict[str, Any]:
+        """Attach the run metrics to the result and hand them to the sink."""
+        metrics.finish()
+        result["metrics"] = metrics.to_dict()
+        
+        if self.metrics_sink is not None:
+            try:
+                self.metrics_sink.emit(result["metrics"])
+            except Exception as e:
+                logger.error(f"Error emitting metrics: {str(e)}")
+        
+        return result
+    
+    def _async_llm(self):
+        """Return the LLM to use from the running event loop."""
+        factory = self.client_factory
+        if factory is None or self.llm is not factory.get_llm(self.model, self.temperature, self.base_url, self.api_key):
+            return self.llm
+        return factory.get_async_llm(self.model, self.temperature, self.base_url, self.api_key)
+    
+    def _should_retry(self, error: Exception, attempt: int) -> bool:
+        """Return whether a failed LLM call should be retried."""
+        if attempt + 1 >= self.max_attempts or not _is_retryable_error(error):
+            return False
+        return True
+    
+    def _reconcile_tokens(self, response: Any, estimated: int) -> None:
+        """Correct the rate limiter's token estimate with the reported usage."""
+        total = _usage_total_tokens(response)
+        if self.rate_limiter is not None and total:
+            self.rate_limiter.adjust(total - estimated)
+    
+    def _refund_tokens(self, estimated: int) -> None:
+        """Give back the tokens reserved for a call that failed without using them."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.adjust(-estimated)
+    
+    def _call_llm(self, call: Callable[[], Any], prompt: Any) -> Any:
+        """Run a synchronous LLM call under the rate limiter, retrying transient errors."""
+        estimated = _estimate_tokens(prompt)
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(estimated)
+            try:
+                response = call()
+                self._reconcile_tokens(response, estimated)
+                return response
+            except Exception as e:
+                self._refund_tokens(estimated)
+                if not self._should_retry(e, attempt):
+                    raise
+                delay = _retry_delay(attempt, e)
+                logger.warning(f"LLM call failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+    
+    async def _acall_llm(self, call: Callable[[], Awaitable[Any]], prompt: Any) -> Any:
+        """Async variant of _call_llm."""
+        estimated = _estimate_tokens(prompt)
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.aacquire(estimated)
+            try:
+                response = await call()
+                self._reconcile_tokens(response, estimated)
+                return response
+            except Exception as e:
+                self._refund_tokens(estimated)
+                if not self._should_retry(e, attempt):
+                    raise
+                delay = _retry_delay(attempt, e)
+                logger.warning(f"LLM call failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+    
+    def _stream_llm(self, prompt: Any):
+        """Yield chunks of a streamed completion.
+        
+        Transient errors are retried as long as no chunk has been yielded
+        yet; a stream that breaks midway is not restarted.
+        """
+        estimated = _estimate_tokens(prompt)
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(estimated)
+            started = False
+            try:
+                for chunk in self.llm.stream(prompt):
+                    started = True
+                    self._reconcile_tokens(chunk, estimated)
+                    yield chunk
+                return
+            except Exception as e:
+                if not started:
+                    self._refund_tokens(estimated)
+                if started or not self._should_retry(e, attempt):
+                    raise
+                delay = _retry_delay(attempt, e)
+                logger.warning(f"LLM stream failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+    
+    def _cache_key(self, prompt: str, variant: str = "") -> Optional[str]:
+        """Return the response cache key for prompt, or None without a cache."""
+        if self.response_cache is None:
+            return None
+        return LLMResponseCache.make_key(prompt + variant, self.model, self.temperature, self.base_url)
+    
+    def _cached_response(self, cache_key: Optional[str], metrics: Optional[RunMetrics] = None) -> Optional[str]:
+        """Return the cached response for cache_key, if any."""
+        if cache_key is None:
+            return None
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Serving LLM response from cache")
+            if metrics is not None:
+                metrics.add("llm_cache_hits")
+        return cached
+    
+    def _store_response(self, cache_key: Optional[str], response: str) -> None:
+        """Store a response in the cache when caching is enabled."""
+        if cache_key is not None:
+            self.response_cache.set(cache_key, response)
+    
+    def _invoke_llm(self, prompt: str, metrics: Optional[RunMetrics] = None) -> str:
+        """Send the prompt to the LLM, serving repeated prompts from the cache."""
+        metrics = metrics or RunMetrics()
+        cache_key = self._cache_key(prompt)
+        content = self._cached_response(cache_key, metrics)
+        if content is None:
+            response = self._call_llm(lambda: self.llm.invoke(prompt), prompt)
+            metrics.add("llm_calls")
+            metrics.record_usage(response)
             content = response.content
+            self._store_response(cache_key, content)
+        return content
+    
+    async def _ainvoke_llm(self, prompt: str, metrics: Optional[RunMetrics] = None) -> str:
+        """Async variant of _invoke_llm."""
+        metrics = metrics or RunMetrics()
+        cache_key = self._cache_key(prompt)
+        content = self._cached_response(cache_key, metrics)
+        if content is None:
+            response = await self._acall_llm(lambda: self._async_llm().ainvoke(prompt), prompt)
+            metrics.add("llm_calls")
+            metrics.record_usage(response)
+            content = response.content
+            self._store_response(cache_key, content)
+        return content
+    
+    def _structured_llm(self, schema: Dict[str, Any], llm: Any = None):
+        """Return the LLM (self.llm by default) bound to a strict JSON-schema response format.
+        
+        The runnable returns {"raw": message, "parsed": data, ...} so that
+        token usage stays available; see _parse_structured.
+        """
+        llm = llm or self.llm
+        return llm.with_structured_output(schema, method="json_schema", strict=True, include_raw=True)
+    
+    @staticmethod
+    def _salvage_structured_text(output: Dict[str, Any]) -> Optional[str]:
+        """Return the report text of a structured response that failed to parse, if any.
+        
+        Truncated JSON still yields its text_content when that field was
+        complete; a plain text answer (such as a refusal) is returned as is.
+        """
+        raw = output.get("raw")
+        text = getattr(raw, "content", None)
+        if not isinstance(text, str) or not text.strip():
+            return None
+        
+        if text.lstrip().startswith("{"):
+            match = re.search(r'"text_content"\s*:\s*("(?:[^"\\]|\\.)*")', text)
+            return json.loads(match.group(1)) if match else None
+        return text
+    
+    def _parse_structured(self, output: Dict[str, Any], metrics: RunMetrics) -> Dict[str, Any]:
+        """Record usage of a structured call and return its parsed data."""
+        metrics.add("llm_calls")
+        metrics.record_usage(output.get("raw"))
+        if output.get("parsing_error") is not None or not isinstance(output.get("parsed"), dict):
+            raise ValueError(f"Could not parse structured output: {output.get('parsing_error')}")
+        return output["parsed"]
+    
+    def _invoke_structured(self, prompt: str,
+                           metrics: Optional[RunMetrics] = None) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """Ask for the report as structured output and return (text, charts_data).
+        
+        If the output cannot be parsed, returns whatever report text could be
+        salvaged with charts_data None, so the charts are extracted or
+        repaired from the text; text is None when nothing was usable.
+        """
+        metrics = metrics or RunMetrics()
+        cache_key = self._cache_key(prompt, variant="#structured")
+        cached = self._cached_response(cache_key, metrics)
+        if cached is not None:
+            report = json.loads(cached)
+        else:
+            output = self._call_llm(lambda: self._structured_llm(REPORT_SCHEMA).invoke(prompt), prompt)
+            try:
+                report = self._parse_structured(output, metrics)
+            except ValueError as e:
+                logger.warning(f"{str(e)}; falling back to the report text")
+                return self._salvage_structured_text(output), None
+            self._store_response(cache_key, json.dumps(report))
+        
+        return report.get("text_content", ""), {"charts": report.get("charts")}
+    
+    async def _ainvoke_structured(self, prompt: str,
+                                  metrics: Optional[RunMetrics] = None) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """Async variant of _invoke_structured."""
+        metrics = metrics or RunMetrics()
+        cache_key = self._cache_key(prompt, variant="#structured")
+        cached = self._cached_response(cache_key, metrics)
+        if cached is not None:
+            report = json.loads(cached)
+        else:
+            output = await self._acall_llm(
+                lambda: self._structured_llm(REPORT_SCHEMA, self._async_llm()).ainvoke(prompt),
+                prompt
+            )
+            try:
+                report = self._parse_structured(output, metrics)
+            except ValueError as e:
+                logger.warning(f"{str(e)}; falling back to the report text")
+                return self._salvage_structured_text(output), None
+            self._store_response(cache_key, json.dumps(report))
+        
+        return report.get("text_content", ""), {"charts": report.get("charts")}
+    
+    def _analyze_instruction(self, instruction: str):
+        """Return whether the instruction asks for visualizations and for a PDF."""
+        return analyze_instruction(instruction)
+    
+    def _build_prompt(self, instruction: str, needs_visualization: bool, inline_charts: bool = True,
+                      reference: Optional[str] = None) -> str:
+        """Build the LLM prompt for the instruction.
+        
+        With inline_charts, chart data is requested as a JSON block inside
+        the response; otherwise it is requested in a separate field of a
+        structured response. A reference report for a similar earlier
+        request is offered to the LLM as a starting point.
+        """
+        # Create a prompt that instructs the LLM to handle the task
+        prompt = f"""
+        I need you to help me with the following task:
+        
+        {instruction}
+        
+        Please approach this task step by step:
+        1. Think about what information is needed
+        2. Consider what you already know about this topic
+        3. Provide a detailed response that addresses the task
+        """
+        
+        # Add visualization instructions if needed
+        if needs_visualization and not inline_charts:
+            prompt += """
+            4. Put the full response in markdown in the text_content field, and the data
+               for the visualizations in the charts field
             
-            # Process the response
-            result = {
-                "text_content": content,
-                "charts_data": None,
-                "pdf_path": None
-            }
+            Provide realistic and representative data based on your knowledge of the topic.
+            """
+        elif needs_visualization:
+            prompt += """
+            4. Include data for visualizations in the following JSON format:
             
-            # Extract chart data if present
-            if needs_visualization:
-                try:
-                    # Try to extract JSON data for charts
-                    import json
-                    import re
-                    
-                    # Look for JSON blocks in the content
-                    json_match = re.search(r'```json\s*(.*?)\s*```', content, re.DOTALL)
-                    if json_match:
-                        json_str = json_match.group(1)
-                        charts_data = json.loads(json_str)
-                        result["charts_data"] = charts_data
-                        
-                        # Create visualizations
-                        chart_paths = self._create_visualizations(charts_data)
-                        result["chart_paths"] = chart_paths
-                    else:
-                        # If no JSON block found, try to extract data in a different way
-                        logger.warning("No JSON chart data found in the response")
-                except Exception as e:
-                    logger.error(f"Error extracting chart data: {str(e)}")
+            ```json
+            {{
+                "charts": [
+                    {{
+                        "title": "Chart Title",
+                        "type": "line|bar|pie|scatter",
+                        "x_label": "X-Axis Label",
+                        "y_label": "Y-Axis Label",
+                        "data": {{
+                            "labels": ["Label1", "Label2", "Label3", ...],
+                            "datasets": [
+                                {{
+                                    "label": "Dataset Label",
+                                    "values": [value1, value2, value3, ...]
+                                }},
+                                ...
+                            ]
+                        }}
+                    }},
+                    ...
+                ]
+            }}
+            ```
             
-            # Generate PDF if requested
-            if needs_pdf:
-                try:
+            Provide realistic and representative data based on your knowledge of the topic.
+            """
+        
+        if reference:
+            prompt += f"""
+            
+            The report below was written for a very similar earlier request. Use it as
+            a starting point: keep what still applies, and change whatever this task
+            asks for differently.
+            
+            {reference[:INSTRUCTION_REFERENCE_CHARS]}
+            """
+        
+        return prompt
+    
+    def _process_response(self, content: str, needs_visualization: bool, needs_pdf: bool,
+                          charts_data: Optional[Dict[str, Any]] = None,
+                          metrics: Optional[RunMetrics] = None,
+                          scheduled: Optional[List[Tuple[str, str, Any]]] = None) -> Dict[str, Any]:
+        """Turn the LLM response into the result dict, building charts and PDF as needed.
+        
+        charts_data is given when the charts came back through structured
+        output or were already parsed from a stream; otherwise they are
+        extracted from the response text. scheduled holds the renders already
+        started for charts_data; see _render_charts.
+        """
+        metrics = metrics or RunMetrics()
+        
+        # Process the response
+        result = {
+            "text_content": content,
+            "charts_data": None,
+            "pdf_path": None,
+            "run_dir": self.output_manager.new_run()
+        }
+        artifacts: List[ChartArtifact] = []
+        
+        # Save the text with the rest of the run so that it counts towards bytes_written
+        try:
+            result["text_path"] = atomic_write(os.path.join(result["run_dir"], "report.txt"), content)
+            metrics.record_file(result["text_path"])
+        except Exception as e:
+            logger.error(f"Error saving text output: {str(e)}")
+        
+        # Extract chart data if present
+        if needs_visualization:
+            try:
+                with metrics.stage("chart_extraction"):
+                    if charts_data is not None:
+                        try:
+                            charts_data = validate_charts_data(charts_data)
+                        except ValueError as e:
+                            logger.warning(f"Invalid structured chart data: {str(e)}")
+                            charts_data = self._repair_chart_data(content, metrics)
+                    else:
+                        charts_data = self._extract_chart_data(content, metrics)
+                
+                if charts_data:
+                    result["charts_data"] = charts_data
+                    
+                    # Create visualizations; the PDF reuses the same artifacts
+                    with metrics.stage("chart_render"):
+                        artifacts = self._render_charts(charts_data, metrics, scheduled)
+                    result["chart_paths"] = self._create_visualizations(artifacts, result["run_dir"], metrics)
+            except Exception as e:
+                logger.error(f"Error extracting chart data: {str(e)}")
+        
+        # Generate PDF if requested
+        if needs_pdf:
+            try:
+                with metrics.stage("pdf"):
                     pdf_path = self._generate_pdf(
                         content, 
-                        result.get("charts_data"), 
-                        f"report_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+                        artifacts, 
+                        os.path.join(result["run_dir"], "report.pdf"),
+                        metrics
                     )
-                    result["pdf_path"] = pdf_path
-                except Exception as e:
-                    logger.error(f"Error generating PDF: {str(e)}")
-            
-            return result
-            
+                result["pdf_path"] = pdf_path
+            except Exception as e:
+                logger.error(f"Error generating PDF: {str(e)}")
+        
+        return result
+    
+    def _extract_chart_data(self, content: str, metrics: Optional[RunMetrics] = None) -> Optional[Dict[str, Any]]:
+        """Extract and validate the ```json chart block from the response text.
+        
+        Falls back to a targeted repair call when the block is missing or
+        invalid, instead of dropping the charts.
+        """
+        # Look for JSON blocks in the content
+        json_match = re.search(r'```json\s*(.*?)\s*```', content, re.DOTALL)
+        if json_match:
+            try:
+                return validate_charts_data(json.loads(json_match.group(1)))
+            except ValueError as e:
+                logger.warning(f"Invalid JSON chart data in the response: {str(e)}")
+        else:
+            logger.warning("No JSON chart data found in the response")
+        
+        return self._repair_chart_data(content, metrics)
+    
+    def _repair_chart_data(self, content: str, metrics: Optional[RunMetrics] = None) -> Optional[Dict[str, Any]]:
+        """Ask the LLM for only the chart data that belongs with content.
+        
+        This is a single short structured call, much cheaper than generating
+        the whole response again. Returns None if repair is disabled or fails.
+        """
+        if not self.repair_charts:
+            return None
+        
+        logger.info("Requesting missing chart data from the LLM")
+        prompt = f"""
+        The analysis below was supposed to come with data for its charts, but the
+        chart data was missing or invalid. Return only the chart data for this
+        analysis; do not repeat the analysis itself.
+        
+        {content[:CHART_REPAIR_CONTEXT_CHARS]}
+        """
+        
+        try:
+            output = self._call_llm(lambda: self._structured_llm(CHARTS_SCHEMA).invoke(prompt), prompt)
+            return validate_charts_data(self._parse_structured(output, metrics or RunMetrics()))
         except Exception as e:
-            logger.error(f"Error executing instruction: {str(e)}")
-            return {"text_content": f"Error: {str(e)}", "charts_data": None, "pdf_path": None}
+            logger.error(f"Error repairing chart data: {str(e)}")
+            return None
     
-    def _create_visualizations(self, charts_data: Dict[str, Any]) -> List[str]:
-        """Create visualizations based on the provided data."""
+    def _create_visualizations(self, artifacts: List[ChartArtifact], run_dir: Optional[str] = None,
+                               metrics: Optional[RunMetrics] = None) -> List[str]:
+        """Write rendered charts to run_dir (a new run directory if omitted).
+        
+        Returns their paths, which is empty when the agent keeps charts in
+        memory only.
+        """
+        metrics = metrics or RunMetrics()
         chart_paths = []
+        if not self.save_chart_files or not artifacts:
+            return chart_paths
+        
+        try:
+            with metrics.stage("chart_save"):
+                run_dir = run_dir or self.output_manager.new_run()
+                for i, artifact in enumerate(artifacts):
+                    chart_path = atomic_write(os.path.join(run_dir, f"chart_{i+1}.png"), artifact.png_bytes)
+                    metrics.record_file(chart_path)
+                    chart_paths.append(chart_path)
+        
+        except Exception as e:
+            logger.error(f"Error saving visualizations: {str(e)}")
+        
+        return chart_paths
+    
+    def _get_render_pool(self) -> Executor:
+        """Return the chart rendering pool, creating it on first use."""
+        with self._render_pool_lock:
+            if self._render_pool is None:
+                if self.render_executor == "process":
+                    self._render_pool = ProcessPoolExecutor(max_workers=self.render_workers)
+                else:
+                    self._render_pool = ThreadPoolExecutor(
+                        max_workers=self.render_workers,
+                        thread_name_prefix="chart-render"
+                    )
+            return self._render_pool
+    
+    def _get_report_template(self) -> ReportTemplate:
+        """Return the PDF report template, creating it on first use."""
+        with self._report_template_lock:
+            if self._report_template is None:
+                self._report_template = ReportTemplate()
+            return self._report_template
+    
+    def close(self) -> None:
+        """Shut down the chart rendering pool."""
+        with self._render_pool_lock:
+            if self._render_pool is not None:
+                self._render_pool.shutdown(wait=True)
+                self._render_pool = None
+    
+    def _schedule_charts(self, charts_data: Dict[str, Any]) -> List[Tuple[str, str, Any]]:
+        """Start rendering every chart that is not already stored or in flight.
+        
+        Returns (key, title, artifact-or-future) for each chart, in order.
+        """
+        scheduled = []
+        
+        # Process each chart in the data
+        for i, chart in enumerate(charts_data.get("charts", [])):
+            title = chart.get("title", f"Chart {i+1}")
+            chart_key = ChartArtifactStore.spec_key(dict(chart, title=title))
+            
+            # Reuse the chart if this spec has already been rendered
+            cached = self.chart_store.get(chart_key)
+            if cached is not None:
+                scheduled.append((chart_key, title, cached))
+                continue
+            
+            # Share a render that is already running for the same spec
+            with self._inflight_lock:
+                future = self._inflight_renders.get(chart_key)
+                if future is None:
+                    future = self._get_render_pool().submit(_render_chart_timed, chart, title)
+                    self._inflight_renders[chart_key] = future
+            
+            scheduled.append((chart_key, title, future))
+        
+        return scheduled
+    
+    def _collect_chart(self, chart_key: str, title: str, future: Future,
+                       metrics: Optional[RunMetrics] = None) -> ChartArtifact:
+        """Wait for a scheduled render and move its result into the store."""
+        try:
+            png_bytes, render_time = future.result()
+            if metrics is not None:
+                metrics.record_chart(title, render_time, reused=False)
+        finally:
+            with self._inflight_lock:
+                owner = self._inflight_renders.get(chart_key) is future
+                if owner:
+                    del self._inflight_renders[chart_key]
+        
+        # Only the first collector of a shared render stores it, outside the lock since it may write to disk
+        artifact = ChartArtifact(chart_key, title, png_bytes)
+        if owner:
+            self.chart_store.put(artifact)
+        return artifact
+    
+    def _release_renders(self, scheduled: List[Tuple[str, str, Any]]) -> None:
+        """Make sure renders scheduled by a run leave the in-flight table even if the run never collects them.
+        
+        A render that is still registered when it finishes is moved into
+        the store; renders the run did collect are left alone.
+        """
+        def collect(chart_key: str, title: str, future: Future) -> None:
+            with self._inflight_lock:
+                if self._inflight_renders.get(chart_key) is not future:
+                    return
+            try:
+                self._collect_chart(chart_key, title, future)
+            except Exception as e:
+                logger.error(f"Error rendering chart '{title}': {str(e)}")
+        
+        for chart_key, title, pending in scheduled:
+            if isinstance(pending, Future):
+                pending.add_done_callback(
+                    lambda future, chart_key=chart_key, title=title: collect(chart_key, title, future)
+                )
+    
+    def _render_charts(self, charts_data: Dict[str, Any], metrics: Optional[RunMetrics] = None,
+                       scheduled: Optional[List[Tuple[str, str, Any]]] = None) -> List[ChartArtifact]:
+        """Render the charts into in-memory PNG artifacts.
+        
+        Charts already present in the artifact store are reused instead of
+        being rendered again; the rest are rendered in parallel. scheduled
+        is what _schedule_charts already returned for charts_data during the
+        run, so that its keys are not computed again.
+        """
+        artifacts = []
         
         try:
-            # Process each chart in the data
-            for i, chart in enumerate(charts_data.get("charts", [])):
-                plt.figure(figsize=(10, 6))
-                
-                chart_type = chart.get("type", "bar")
-                title = chart.get("title", f"Chart {i+1}")
-                x_label = chart.get("x_label", "")
-                y_label = chart.get("y_label", "")
-                
-                data = chart.get("data", {})
-                labels = data.get("labels", [])
-                datasets = data.get("datasets", [])
-                
-                if chart_type == "bar":
-                    for j, dataset in enumerate(datasets):
-                        dataset_label = dataset.get("label", f"Dataset {j+1}")
-                        values = dataset.get("values", [])
-                        x = np.arange(len(labels))
-                        width = 0.8 / len(datasets)
-                        offset = j * width - (len(datasets) - 1) * width / 2
-                        plt.bar(x + offset, values, width, label=dataset_label)
-                    plt.xticks(np.arange(len(labels)), labels)
-                
-                elif chart_type == "line":
-                    for j, dataset in enumerate(datasets):
-                        dataset_label = dataset.get("label", f"Dataset {j+1}")
-                        values = dataset.get("values", [])
-                        plt.plot(labels, values, marker='o', label=dataset_label)
-                
-                elif chart_type == "pie":
-                    # Use only the first dataset for pie charts
-                    if datasets:
-                        values = datasets[0].get("values", [])
-                        plt.pie(values, labels=labels, autopct='%1.1f%%', startangle=90)
-                        plt.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle
-                
-                elif chart_type == "scatter":
-                    for j, dataset in enumerate(datasets):
-                        dataset_label = dataset.get("label", f"Dataset {j+1}")
-                        values = dataset.get("values", [])
-                        # For scatter plots, we need x and y values
-                        if len(labels) == len(values):
-                            plt.scatter(labels, values, label=dataset_label)
-                
-                plt.title(title)
-                plt.xlabel(x_label)
-                plt.ylabel(y_label)
-                if len(datasets) > 1:
-                    plt.legend()
-                plt.tight_layout()
-                
-                # Save the chart
-                chart_filename = f"chart_{i+1}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-                plt.savefig(chart_filename)
-                plt.close()
+            for chart_key, title, pending in scheduled or self._schedule_charts(charts_data):
+                if isinstance(pending, ChartArtifact):
+                    if metrics is not None:
+                        metrics.record_chart(title, None, reused=True)
+                    artifacts.append(pending)
+                    continue
                 
-                chart_paths.append(chart_filename)
+                try:
+                    artifacts.append(self._collect_chart(chart_key, title, pending, metrics))
+                except Exception as e:
+                    logger.error(f"Error rendering chart '{title}': {str(e)}")
         
         except Exception as e:
             logger.error(f"Error creating visualizations: {str(e)}")
         
-        return chart_paths
+        return artifacts
     
-    def _generate_pdf(self, content: str, charts_data: Optional[Dict[str, Any]], filename: str) -> str:
-        """Generate a PDF report with the content and charts."""
+    def _generate_pdf(self, content: str, artifacts: Optional[List[ChartArtifact]], filename: str,
+                      metrics: Optional[RunMetrics] = None) -> str:
+        """Generate a PDF report with the content and the already rendered charts.
+        
+        The report is laid out incrementally by a PDFReportBuilder while the
+        markdown content is tokenized, using the agent's shared template.
+        Charts are never rendered here.
+        """
+        metrics = metrics or RunMetrics()
+        artifacts = artifacts or []
+        
         try:
-            # Create a PDF document
-            doc = SimpleDocTemplate(filename, pagesize=letter)
-            styles = getSampleStyleSheet()
-            
-            # Create custom styles
-            title_style = ParagraphStyle(
-                'TitleStyle',
-                parent=styles['Heading1'],
-                fontSize=18,
-                spaceAfter=12
-            )
-            
-            heading_style = ParagraphStyle(
-                'HeadingStyle',
-                parent=styles['Heading2'],
-                fontSize=14,
-                spaceAfter=10
-            )
-            
-            normal_style = ParagraphStyle(
-                'NormalStyle',
-                parent=styles['Normal'],
-                fontSize=10,
-                spaceAfter=8
-            )
-            
-            # Process content for PDF
-            story = []
-            
-            # Extract title from content (assuming first line is title)
-            lines = content.split('\n')
-            title = "Report"
-            content_start = 0
-            
-            for i, line in enumerate(lines):
-                if line.strip().startswith('# '):
-                    title = line.strip('# ')
-                    content_start = i + 1
-                    break
-            
-            # Add title
-            story.append(Paragraph(title, title_style))
-            story.append(Spacer(1, 0.25*inch))
-            
-            # Process content by sections
-            current_section = []
-            in_code_block = False
+            builder = PDFReportBuilder(filename, self._get_report_template(), compact=self.compact_pdf)
             
-            for line in lines[content_start:]:
-                # Handle code blocks
-                if line.strip().startswith('```'):
-                    in_code_block = not in_code_block
-                    continue
-                
-                # Handle headings
-                if not in_code_block and line.strip().startswith('## '):
-                    # Add previous section if exists
-                    if current_section:
-                        story.append(Paragraph('\n'.join(current_section), normal_style))
-                        current_section = []
-                    
-                    # Add new heading
-                    heading = line.strip('## ')
-                    story.append(Spacer(1, 0.2*inch))
-                    story.append(Paragraph(heading, heading_style))
-                    continue
+            with metrics.stage("pdf_build"), atomic_output(filename) as tmp_filename:
+                builder.start(tmp_filename)
+                builder.add_markdown(content)
                 
-                # Skip JSON blocks
-                if in_code_block and 'json' in line:
-                    continue
-                
-                # Add line to current section
-                if not (in_code_block and line.strip().startswith('{')):
-                    current_section.append(line)
-            
-            # Add final section
-            if current_section:
-                story.append(Paragraph('\n'.join(current_section), normal_style))
-            
-            # Add charts if available
-            if charts_data and hasattr(self, '_create_visualizations'):
-                chart_paths = self._create_visualizations(charts_data)
+                # Add charts if available
+                if artifacts:
+                    builder.add_heading("Visualizations", space_before=0.3)
+                    for artifact in artifacts:
+                        builder.add_image(artifact)
                 
-                if chart_paths:
-                    story.append(Spacer(1, 0.3*inch))
-                    story.append(Paragraph("Visualizations", heading_style))
-                    
-                    for chart_path in chart_paths:
-                        story.append(Spacer(1, 0.2*inch))
-                        img = Image(chart_path, width=6*inch, height=3.5*inch)
-                        story.append(img)
+                pages = builder.finish()
             
-            # Build the PDF
-            doc.build(story)
+            metrics.record_file(filename)
+            metrics.add("pdf_pages", pages)
             logger.info(f"PDF report generated: {filename}")
             
             return filename
@@ -330,15 +3384,139 @@ class EnhancedLLMAgent:
             return ""
 
 
-def save_output_to_file(content, prefix="output"):
-    """Save the output content to a text file with timestamp."""
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{prefix}_{timestamp}.txt"
+class ReplayMessage:
+    """A minimal chat message returned by ReplayChatModel."""
+    
+    def __init__(self, content: str, usage_metadata: Optional[Dict[str, int]] = None):
+        """Initialize the message with its text and token usage."""
+        self.content = content
+        self.usage_metadata = usage_metadata
+
+
+class ReplayChatModel:
+    """A local stand-in for ChatOpenAI that replays recorded responses.
+    
+    Responses are picked by the first recorded "match" string found in the
+    prompt, falling back to the default response. Each call waits
+    latency_s seconds, and streaming waits a further token_latency_s per
+    token, so runs behave like a network-bound model without any network.
+    
+    "{prompt_id}" in a recorded response is replaced by a short hash of the
+    prompt, so distinct prompts can get distinct chart specs.
+    """
+    
+    def __init__(self, responses: Dict[str, str], default: Optional[str] = None,
+                 latency_s: float = 0.0, token_latency_s: float = 0.0):
+        """Initialize the model with a mapping of prompt substrings to responses."""
+        self.model_name = "replay"
+        self.temperature = 0
+        self.responses = responses
+        self.default = default
+        self.latency_s = latency_s
+        self.token_latency_s = token_latency_s
+    
+    @classmethod
+    def from_jsonl(cls, path: str, **kwargs) -> "ReplayChatModel":
+        """Load recorded responses from lines of {"match": ..., "response": ...}.
+        
+        A record without "match" becomes the default response.
+        """
+        responses = {}
+        default = None
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get("match"):
+                    responses[record["match"]] = record["response"]
+                else:
+                    default = record["response"]
+        return cls(responses, default=default, **kwargs)
+    
+    def _select(self, prompt: Any) -> str:
+        """Return the recorded response for prompt."""
+        prompt = str(prompt)
+        response = next(
+            (response for match, response in self.responses.items() if match in prompt),
+            self.default
+        )
+        if response is None:
+            raise KeyError("No recorded response matches the prompt")
+        prompt_id = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8]
+        return response.replace("{prompt_id}", prompt_id)
+    
+    @staticmethod
+    def _usage(prompt: Any, response: str) -> Dict[str, int]:
+        """Estimate token usage at roughly four characters per token."""
+        input_tokens = len(str(prompt)) // 4
+        output_tokens = len(response) // 4
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens
+        }
+    
+    def invoke(self, prompt: Any) -> ReplayMessage:
+        """Return the recorded response after the configured latency."""
+        response = self._select(prompt)
+        time.sleep(self.latency_s)
+        return ReplayMessage(response, self._usage(prompt, response))
+    
+    async def ainvoke(self, prompt: Any) -> ReplayMessage:
+        """Async variant of invoke."""
+        response = self._select(prompt)
+        await asyncio.sleep(self.latency_s)
+        return ReplayMessage(response, self._usage(prompt, response))
+    
+    def stream(self, prompt: Any):
+        """Yield the recorded response in whitespace-delimited chunks."""
+        response = self._select(prompt)
+        time.sleep(self.latency_s)
+        for token in re.findall(r"\S+\s*|\s+", response):
+            time.sleep(self.token_latency_s)
+            yield ReplayMessage(token)
+        yield ReplayMessage("", self._usage(prompt, response))
+    
+    def with_structured_output(self, schema: Dict[str, Any], **kwargs) -> "_ReplayStructuredModel":
+        """Return a model whose recorded responses are JSON for schema."""
+        return _ReplayStructuredModel(self)
+
+
+class _ReplayStructuredModel:
+    """Structured-output view of a ReplayChatModel, shaped like include_raw=True."""
+    
+    def __init__(self, model: ReplayChatModel):
+        """Wrap the replay model."""
+        self.model = model
+    
+    @staticmethod
+    def _parse(message: ReplayMessage) -> Dict[str, Any]:
+        """Parse the recorded JSON the way the real client does."""
+        try:
+            return {"raw": message, "parsed": json.loads(message.content), "parsing_error": None}
+        except ValueError as e:
+            return {"raw": message, "parsed": None, "parsing_error": e}
+    
+    def invoke(self, prompt: Any) -> Dict[str, Any]:
+        """Return the parsed recorded response."""
+        return self._parse(self.model.invoke(prompt))
+    
+    async def ainvoke(self, prompt: Any) -> Dict[str, Any]:
+        """Async variant of invoke."""
+        return self._parse(await self.model.ainvoke(prompt))
+
+
+def save_output_to_file(content, prefix="output", output_dir=None):
+    """Save the output content to a text file in a run directory.
     
-    with open(filename, "w", encoding="utf-8") as file:
-        file.write(content)
+    Uses output_dir when given (normally the run_dir of an execute() result),
+    otherwise a new run directory under OUTPUT_ROOT.
+    """
+    output_dir = output_dir or OutputManager().new_run(prefix)
+    filename = os.path.join(output_dir, f"{prefix}.txt")
     
-    return filename
+    return atomic_write(filename, content)
 
 
 def display_menu():
@@ -404,19 +3582,7 @@ def get_custom_instruction():
 
 def run_predefined_task(agent, task_name):
     """Run a predefined task."""
-    tasks = {
-        "basic": "Research renewable energy trends over the past decade. Create charts showing the growth "
-                "of solar, wind, and hydroelectric power. Generate a PDF report with your findings and visualizations.",
-        
-        "intermediate": "Compare key economic indicators (GDP growth, inflation, unemployment) for the top 5 "
-                       "global economies over the past 5 years. Create appropriate visualizations for each indicator "
-                       "and compile your analysis into a comprehensive PDF report.",
-        
-        "advanced": "Analyze climate change data including global temperature changes, sea level rise, and carbon "
-                   "emissions over the past century. Create multiple visualizations showing these trends and their "
-                   "correlations. Compile a detailed PDF report with your analysis, visualizations, and potential "
-                   "future scenarios based on current trends."
-    }
+    tasks = PREDEFINED_TASKS
     
     if task_name not in tasks:
         logger.error(f"Unknown task: {task_name}")
@@ -430,9 +3596,10 @@ def run_predefined_task(agent, task_name):
     # Execute the instruction using the agent
     result = agent.execute(instruction)
     
-    # Save the text content to a file
-    text_content = result["text_content"]
-    output_file = save_output_to_file(text_content, f"task_{task_name}")
+    # The run saves its text itself; failed runs are saved here
+    output_file = result.get("text_path") or save_output_to_file(
+        result["text_content"], f"task_{task_name}", result.get("run_dir")
+    )
     
     # Return information about all outputs
     output_info = f"Task: {task_name}\n"
@@ -447,17 +3614,45 @@ def run_predefined_task(agent, task_name):
     return output_info
 
 
-def run_custom_instruction(agent, instruction):
-    """Run a custom instruction."""
-    print(f"\nRunning your custom instruction...")
-    print("\nProcessing... (this may take a few minutes)")
+def _served_result_available(result: Dict[str, Any]) -> bool:
+    """Return whether the files of an earlier result still exist."""
+    paths = [result.get("run_dir"), result.get("text_path"), result.get("pdf_path")] + list(result.get("chart_paths") or [])
+    return all(os.path.exists(path) for path in paths if path)
+
+
+def run_custom_instruction(agent, instruction, instruction_index: Optional[InstructionIndex] = None):
+    """Run a custom instruction.
     
-    # Execute the instruction using the agent
-    result = agent.execute(instruction)
+    With an instruction_index, an instruction close enough to an earlier one
+    reuses that result ("serve" mode) or hands its report to the LLM as a
+    starting point ("seed" mode).
+    """
+    match = instruction_index.lookup(instruction) if instruction_index is not None else None
+    
+    if match and instruction_index.mode == "serve" and _served_result_available(match[1]["result"]):
+        similarity, entry = match
+        print(f"\nServing the result of a similar earlier instruction "
+              f"(similarity {similarity:.2f}): {entry['instruction']}\n")
+        result = dict(entry["result"])
+        print(result["text_content"])
+    else:
+        print(f"\nRunning your custom instruction...\n")
+        
+        # Execute the instruction using the agent, printing tokens as they arrive
+        result = agent.execute_stream(
+            instruction,
+            on_token=lambda token: print(token, end="", flush=True),
+            reference=match[1]["result"]["text_content"] if match else None
+        )
+        print()
+        
+        if instruction_index is not None and not result.get("error"):
+            instruction_index.add(instruction, result)
     
-    # Save the text content to a file
-    text_content = result["text_content"]
-    output_file = save_output_to_file(text_content, "custom_instruction")
+    # The run saves its text itself; failed runs are saved here
+    output_file = result.get("text_path") or save_output_to_file(
+        result["text_content"], "custom_instruction", result.get("run_dir")
+    )
     
     # Return information about all outputs
     output_info = f"Custom Instruction: {instruction}\n"
@@ -472,16 +3667,1025 @@ def run_custom_instruction(agent, instruction):
     return output_info
 
 
-def main():
+def load_jobs(jobs_path: str) -> List[Dict[str, Any]]:
+    """Load batch jobs from a JSONL file.
+    
+    Each line holds an "instruction" or the name of a predefined "task",
+    plus an optional "id"; jobs without an id are named after their line
+    number so that they can be matched up again when resuming.
+    """
+    jobs = []
+    
+    with open(jobs_path, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            
+            job = {"id": f"line-{line_number}"}
+            try:
+                spec = json.loads(line)
+                if not isinstance(spec, dict):
+                    raise ValueError("job must be a JSON object")
+                job["id"] = str(spec.get("id", job["id"]))
+                if spec.get("task") is not None:
+                    if spec["task"] not in PREDEFINED_TASKS:
+                        raise ValueError(f"Unknown task '{spec['task']}'")
+                    job["instruction"] = PREDEFINED_TASKS[spec["task"]]
+                elif isinstance(spec.get("instruction"), str) and spec["instruction"].strip():
+                    job["instruction"] = spec["instruction"]
+                else:
+                    raise ValueError("job needs an 'instruction' or a 'task'")
+            except ValueError as e:
+                job["error"] = f"Invalid job on line {line_number}: {str(e)}"
+            
+            jobs.append(job)
+    
+    return jobs
+
+
+def load_completed_job_ids(results_path: str) -> set:
+    """Return the ids of jobs that already have a successful result line."""
+    completed = set()
+    if not os.path.exists(results_path):
+        return completed
+    
+    with open(results_path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A crash can leave a truncated last line behind
+                continue
+            if isinstance(record, dict) and "id" in record:
+                if record.get("error"):
+                    completed.discard(record["id"])
+                else:
+                    completed.add(record["id"])
+    
+    return completed
+
+
+async def arun_batch(agent: EnhancedLLMAgent, jobs_path: str, results_path: str,
+                     concurrency: int = 4) -> Dict[str, int]:
+    """Run every job in jobs_path and append one JSONL result per job to results_path.
+    
+    At most concurrency jobs run at once. Results are written as soon as each
+    job finishes, and jobs that already succeeded in results_path are
+    skipped, so an interrupted batch can simply be started again.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    
+    jobs = load_jobs(jobs_path)
+    completed = load_completed_job_ids(results_path)
+    pending = [job for job in jobs if job["id"] not in completed]
+    summary = {"total": len(jobs), "skipped": len(jobs) - len(pending), "succeeded": 0, "failed": 0}
+    logger.info(f"Batch: {len(pending)} jobs to run, {summary['skipped']} already completed")
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    
+    async def run_job(job: Dict[str, Any]) -> Dict[str, Any]:
+        record = {
+            "id": job["id"],
+            "instruction": job.get("instruction"),
+            "text_path": None,
+            "chart_paths": [],
+            "pdf_path": None,
+            "timings": {},
+            "error": job.get("error")
+        }
+        if record["error"]:
+            return record
+        
+        async with semaphore:
+            started = time.time()
+            try:
+                result = await agent.aexecute(job["instruction"])
+                record["text_path"] = result.get("text_path") or await loop.run_in_executor(
+                    None, save_output_to_file, result["text_content"], f"batch_{job['id']}", result.get("run_dir")
+                )
+                record["chart_paths"] = result.get("chart_paths") or []
+                record["pdf_path"] = result.get("pdf_path")
+                record["error"] = result.get("error")
+                record["metrics"] = result.get("metrics")
+            except Exception as e:
+                logger.error(f"Error running job {job['id']}: {str(e)}")
+                record["error"] = str(e)
+            
+            record["timings"] = {
+                "started_at": datetime.datetime.fromtimestamp(started).isoformat(),
+                "duration_s": round(time.time() - started, 3)
+            }
+        
+        return record
+    
+    with open(results_path, "a", encoding="utf-8") as results_file:
+        for next_result in asyncio.as_completed([run_job(job) for job in pending]):
+            record = await next_result
+            results_file.write(json.dumps(record) + "\n")
+            results_file.flush()
+            
+            if record["error"]:
+                summary["failed"] += 1
+            else:
+                summary["succeeded"] += 1
+    
+    return summary
+
+
+def run_batch(agent: EnhancedLLMAgent, jobs_path: str, results_path: str, concurrency: int = 4) -> Dict[str, int]:
+    """Synchronous wrapper around arun_batch."""
+    return agent.run_async(arun_batch(agent, jobs_path, results_path, concurrency))
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue already holds its maximum number of unfinished jobs."""
+
+
+class JobQueue:
+    """SQLite-backed job queue shared by the API and the worker processes.
+    
+    Workers claim a job with a lease that they renew while it runs. If a
+    worker dies, its lease runs out and the job is queued again, until it
+    has been attempted max_attempts times. submit() raises QueueFullError
+    once max_pending jobs are queued or running, so callers back off
+    instead of piling up work.
+    """
+    
+    def __init__(self, path: str = JOB_QUEUE_PATH, max_pending: int = JOB_QUEUE_MAX_PENDING,
+                 max_attempts: int = JOB_MAX_ATTEMPTS):
+        """Open (or create) the queue database at path."""
+        self.path = path
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        
+        # Transactions are explicit (BEGIN IMMEDIATE), since several processes write
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                instruction TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_expires REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                result TEXT,
+                error TEXT
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+    
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Run the block in a write transaction that locks out other processes."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+    
+    def submit(self, instruction: str, job_id: Optional[str] = None) -> str:
+        """Queue an instruction and return its job id."""
+        job_id = job_id or uuid.uuid4().hex
+        now = time.time()
+        
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM jobs WHERE id = ?", (job_id,)).fetchone():
+                raise ValueError(f"Job '{job_id}' already exists")
+            
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')"
+            ).fetchone()[0]
+            if pending >= self.max_pending:
+                raise QueueFullError(f"Job queue is full ({pending} unfinished jobs)")
+            
+            conn.execute(
+                "INSERT INTO jobs (id, instruction, status, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, instruction, now, now)
+            )
+        
+        return job_id
+    
+    def claim(self, worker: str, lease_seconds: float = JOB_LEASE_SECONDS) -> Optional[Dict[str, Any]]:
+        """Lease the oldest queued job to worker, or return None if there is none.
+        
+        Jobs whose lease has run out are queued again first, or failed once
+        they have used up their attempts.
+        """
+        now = time.time()
+        
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                UPDATE jobs SET status = 'failed', error = 'Worker lease expired too many times',
+                    worker = NULL, updated_at = ?
+                WHERE status = 'running' AND lease_expires < ? AND attempts >= ?
+                """,
+                (now, now, self.max_attempts)
+            )
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL, updated_at = ? "
+                "WHERE status = 'running' AND lease_expires < ?",
+                (now, now)
+            )
+            
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            
+            conn.execute(
+                """
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?,
+                    lease_expires = ?, updated_at = ?
+                WHERE id = ?
+                """,
+                (worker, now + lease_seconds, now, row["id"])
+            )
+            job = conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+        
+        return self._job_dict(job)
+    
+    def renew(self, job_id: str, worker: str, lease_seconds: float = JOB_LEASE_SECONDS) -> bool:
+        """Extend worker's lease on a running job; returns False if the lease was lost."""
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (now + lease_seconds, now, job_id, worker)
+            )
+        return cursor.rowcount == 1
+    
+    def finish(self, job_id: str, worker: str, result: Optional[Dict[str, Any]] = None,
+               error: Optional[str] = None) -> bool:
+        """Record the outcome of a job still leased to worker; returns False if the lease was lost."""
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                """
+                UPDATE jobs SET status = ?, result = ?, error = ?, worker = NULL, lease_expires = NULL,
+                    updated_at = ?
+                WHERE id = ? AND worker = ? AND status = 'running'
+                """,
+                ("failed" if error else "done", json.dumps(result) if result is not None else None,
+                 error, now, job_id, worker)
+            )
+        return cursor.rowcount == 1
+    
+    @staticmethod
+    def _job_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        """Convert a jobs row to a dict with the result decoded."""
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+    
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return the job with job_id, or None if there is none."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job_dict(row) if row is not None else None
+    
+    def stats(self) -> Dict[str, int]:
+        """Return the number of jobs in each status."""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        counts.update({row[0]: row[1] for row in rows})
+        return counts
+    
+    def close(self) -> None:
+        """Close the underlying database connection."""
+        with self._lock:
+            self._conn.close()
+
+
+def _warm_up_agent(agent: EnhancedLLMAgent) -> None:
+    """Load the chart and PDF libraries and the report template before the first job."""
+    from matplotlib.figure import Figure  # noqa: F401
+    from matplotlib.backends.backend_agg import FigureCanvasAgg  # noqa: F401
+    
+    agent._get_report_template()
+
+
+def _run_queued_job(agent: EnhancedLLMAgent, queue: JobQueue, job: Dict[str, Any], worker: str,
+                    lease_seconds: float) -> None:
+    """Run one claimed job, renewing its lease until the result is recorded."""
+    stop_renewing = threading.Event()
+    
+    def renew_lease() -> None:
+        while not stop_renewing.wait(lease_seconds / 3):
+            if not queue.renew(job["id"], worker, lease_seconds):
+                logger.warning(f"Worker {worker} lost the lease on job {job['id']}")
+                return
+    
+    renewer = threading.Thread(target=renew_lease, name=f"lease-{job['id']}", daemon=True)
+    renewer.start()
+    
+    try:
+        result = agent.execute(job["instruction"])
+        text_path = result.get("text_path") or save_output_to_file(
+            result["text_content"], f"job_{job['id']}", result.get("run_dir")
+        )
+        record = {
+            "text_path": text_path,
+            "chart_paths": result.get("chart_paths") or [],
+            "pdf_path": result.get("pdf_path"),
+            "run_dir": result.get("run_dir"),
+            "metrics": result.get("metrics")
+        }
+        error = result.get("error")
+    except Exception as e:
+        logger.error(f"Error running job {job['id']}: {str(e)}")
+        record, error = None, str(e)
+    finally:
+        stop_renewing.set()
+        renewer.join()
+    
+    if not queue.finish(job["id"], worker, record, error):
+        logger.warning(f"Result of job {job['id']} was dropped because its lease had expired")
+
+
+def job_worker(queue_path: str, worker: str, stop_event: Any, agent_options: Optional[Dict[str, Any]] = None,
+               lease_seconds: float = JOB_LEASE_SECONDS, poll_interval: float = 0.5,
+               trace_memory: bool = False, requests_per_minute: Optional[int] = None,
+               tokens_per_minute: Optional[int] = None) -> None:
+    """Worker process: build and warm one agent, then run queued jobs until stop_event is set.
+    
+    requests_per_minute and tokens_per_minute are this worker's share of
+    the LLM budgets.
+    """
+    import signal
+    
+    # Ctrl+C reaches the whole process group; the service stops workers through stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if trace_memory:
+        tracemalloc.start()
+    queue = JobQueue(queue_path)
+    agent = EnhancedLLMAgent(
+        openai_api_key=OPENAI_API_KEY,
+        openai_base_url=OPENAI_BASE_URL,
+        response_cache=LLMResponseCache(LLM_CACHE_PATH),
+        chart_cache=ChartDiskCache(CHART_CACHE_DIR),
+        client_factory=LLMClientFactory(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute),
+        **(agent_options or {})
+    )
+    _warm_up_agent(agent)
+    logger.info(f"Worker {worker} ready")
+    
+    try:
+        while not stop_event.is_set():
+            job = queue.claim(worker, lease_seconds)
+            if job is None:
+                stop_event.wait(poll_interval)
+                continue
+            
+            logger.info(f"Worker {worker} running job {job['id']} (attempt {job['attempts']})")
+            _run_queued_job(agent, queue, job, worker, lease_seconds)
+    finally:
+        agent.close()
+        queue.close()
+
+
+class JobService:
+    """Runs a pool of job worker processes and replaces any that die.
+    
+    A job held by a dead worker is picked up again by another worker once
+    its lease runs out, so crashes do not lose jobs. The supervisor also
+    removes expired output every cleanup_interval seconds. The LLM budgets
+    are split evenly between the workers.
+    """
+    
+    def __init__(self, queue_path: str = JOB_QUEUE_PATH, workers: int = 2,
+                 agent_options: Optional[Dict[str, Any]] = None, lease_seconds: float = JOB_LEASE_SECONDS,
+                 output_manager: Optional[OutputManager] = None,
+                 cleanup_interval: float = OUTPUT_CLEANUP_INTERVAL_S, trace_memory: bool = False,
+                 requests_per_minute: Optional[int] = LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: Optional[int] = LLM_TOKENS_PER_MINUTE):
+        """Initialize the service; worker processes start with start()."""
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        
+        import multiprocessing
+        
+        # Spawned workers build their own agent instead of inheriting this process's state
+        self._context = multiprocessing.get_context("spawn")
+        self.queue_path = queue_path
+        self.workers = workers
+        self.agent_options = agent_options or {}
+        self.lease_seconds = lease_seconds
+        self.output_manager = output_manager or OutputManager()
+        self.cleanup_interval = cleanup_interval
+        self.trace_memory = trace_memory
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._stop_event = self._context.Event()
+        self._processes: Dict[str, Any] = {}
+        self._supervisor: Optional[threading.Thread] = None
+    
+    def _start_worker(self, name: str) -> None:
+        """Start (or restart) the worker process called name."""
+        process = self._context.Process(
+            target=job_worker,
+            args=(self.queue_path, name, self._stop_event, self.agent_options, self.lease_seconds),
+            kwargs={
+                "trace_memory": self.trace_memory,
+                "requests_per_minute": self.requests_per_minute and max(1, self.requests_per_minute // self.workers),
+                "tokens_per_minute": self.tokens_per_minute and max(1, self.tokens_per_minute // self.workers)
+            },
+            name=name,
+            daemon=True
+        )
+        process.start()
+        self._processes[name] = process
+    
+    def _supervise(self) -> None:
+        """Restart workers that exit and clean up old output while the service is running."""
+        next_cleanup = time.monotonic()
+        while not self._stop_event.wait(1.0):
+            for name, process in list(self._processes.items()):
+                if not process.is_alive():
+                    logger.warning(f"Worker {name} exited with code {process.exitcode}, restarting it")
+                    self._start_worker(name)
+            
+            if time.monotonic() >= next_cleanup:
+                next_cleanup = time.monotonic() + self.cleanup_interval
+                try:
+                    self.output_manager.cleanup()
+                except Exception as e:
+                    logger.error(f"Error cleaning up output: {str(e)}")
+    
+    def start(self) -> None:
+        """Start the worker processes and their supervisor."""
+        for i in range(self.workers):
+            self._start_worker(f"worker-{i+1}")
+        self._supervisor = threading.Thread(target=self._supervise, name="job-supervisor", daemon=True)
+        self._supervisor.start()
+    
+    def stop(self, timeout: float = 30.0) -> None:
+        """Let the workers finish their current jobs, then stop them."""
+        self._stop_event.set()
+        if self._supervisor is not None:
+            self._supervisor.join()
+        for process in self._processes.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._processes = {}
+
+
+def make_job_server(queue: JobQueue, host: str = JOB_SERVICE_HOST, port: int = JOB_SERVICE_PORT):
+    """Return a threading HTTP server exposing the job queue.
+    
+    POST /jobs with {"instruction": ...} or {"task": ...} (and an optional
+    "id") queues a job and answers 202, or 429 with Retry-After while the
+    queue is full. GET /jobs/<id> returns a job with its status and result,
+    and GET /stats the number of jobs in each status.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    class JobRequestHandler(BaseHTTPRequestHandler):
+        """Handles the job queue API requests."""
+        
+        def _send_json(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> None:
+            """Send payload as a JSON response."""
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def do_POST(self):
+            """Queue a job."""
+            if self.path != "/jobs":
+                self._send_json(404, {"error": "not found"})
+                return
+            
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                spec = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(spec, dict):
+                    raise ValueError("job must be a JSON object")
+                instruction = spec.get("instruction")
+                if spec.get("task") is not None:
+                    if spec["task"] not in PREDEFINED_TASKS:
+                        raise ValueError(f"Unknown task '{spec['task']}'")
+                    instruction = PREDEFINED_TASKS[spec["task"]]
+                if not isinstance(instruction, str) or not instruction.strip():
+                    raise ValueError("job needs an 'instruction' or a 'task'")
+                job_id = queue.submit(instruction, spec.get("id") and str(spec["id"]))
+            except QueueFullError as e:
+                self._send_json(429, {"error": str(e)}, {"Retry-After": "5"})
+                return
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            
+            self._send_json(202, {"id": job_id, "status": "queued"})
+        
+        def do_GET(self):
+            """Return a job or the queue statistics."""
+            if self.path == "/stats":
+                self._send_json(200, queue.stats())
+            elif self.path.startswith("/jobs/"):
+                job = queue.get(self.path[len("/jobs/"):])
+                if job is None:
+                    self._send_json(404, {"error": "job not found"})
+                else:
+                    self._send_json(200, job)
+            else:
+                self._send_json(404, {"error": "not found"})
+        
+        def log_message(self, format, *args):
+            """Log requests through the module logger instead of stderr."""
+            logger.info(f"{self.address_string()} {format % args}")
+    
+    return ThreadingHTTPServer((host, port), JobRequestHandler)
+
+
+def run_job_service(queue_path: str = JOB_QUEUE_PATH, workers: int = 2, host: str = JOB_SERVICE_HOST,
+                    port: int = JOB_SERVICE_PORT, max_pending: int = JOB_QUEUE_MAX_PENDING,
+                    agent_options: Optional[Dict[str, Any]] = None, trace_memory: bool = False,
+                    requests_per_minute: Optional[int] = LLM_REQUESTS_PER_MINUTE,
+                    tokens_per_minute: Optional[int] = LLM_TOKENS_PER_MINUTE) -> None:
+    """Serve the job API and run the worker pool until interrupted."""
+    queue = JobQueue(queue_path, max_pending=max_pending)
+    service = JobService(
+        queue_path,
+        workers,
+        agent_options,
+        trace_memory=trace_memory,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute
+    )
+    server = make_job_server(queue, host, port)
+    
+    service.start()
+    logger.info(f"Job service listening on http://{host}:{port} with {workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+        queue.close()
+
+
+def _synthetic_report(title: str, sections: List[str], charts: List[Tuple[str, str, List[str], List[str]]],
+                      paragraphs: int = 3) -> str:
+    """Build a deterministic markdown report with a JSON chart block.
+    
+    charts holds (title, type, labels, dataset names) tuples. Chart titles
+    carry the "{prompt_id}" placeholder so each benchmark run renders its
+    own charts instead of reusing those of an earlier run.
+    """
+    lines = [f"# {title}", ""]
+    for section in sections:
+        lines.extend([f"## {section}", ""])
+        for p in range(paragraphs):
+            lines.append(
+                f"{section} paragraph {p+1}: the figures show a **steady** trend with year-on-year changes "
+                "driven by policy, prices and adoption. " * 3
+            )
+            lines.append("")
+        lines.extend([f"- Key point one about {section.lower()}", f"- Key point two about {section.lower()}", ""])
+    
+    chart_specs = []
+    for chart_title, chart_type, labels, dataset_names in charts:
+        chart_specs.append({
+            "title": f"{chart_title} ({{prompt_id}})",
+            "type": chart_type,
+            "x_label": "Year" if chart_type != "pie" else "",
+            "y_label": "Value" if chart_type != "pie" else "",
+            "data": {
+                "labels": labels,
+                "datasets": [
+                    {"label": name, "values": [round(10 + 3 * j + 7 * d + (j % 3), 1) for j in range(len(labels))]}
+                    for d, name in enumerate(dataset_names)
+                ]
+            }
+        })
+    
+    lines.extend(["```json", json.dumps({"charts": chart_specs}, indent=2), "```", ""])
+    return "\n".join(lines)
+
+
+def build_benchmark_responses() -> Dict[str, str]:
+    """Return recorded-style responses for the predefined tasks, keyed by task name."""
+    years = [str(year) for year in range(2014, 2024)]
+    economies = ["USA", "China", "Japan", "Germany", "India"]
+    decades = [str(year) for year in range(1920, 2030, 10)]
+    
+    return {
+        "basic": _synthetic_report(
+            "Renewable Energy Trends",
+            ["Overview", "Solar", "Wind", "Hydroelectric", "Conclusion"],
+            [
+                ("Installed Capacity by Source", "line", years, ["Solar", "Wind", "Hydro"]),
+                ("Capacity Added in 2023", "bar", ["Solar", "Wind", "Hydro"], ["GW"]),
+                ("Share of Renewable Generation", "pie", ["Solar", "Wind", "Hydro"], ["Share"]),
+            ]
+        ),
+        "intermediate": _synthetic_report(
+            "Economic Indicators of the Top 5 Economies",
+            ["Overview", "GDP Growth", "Inflation", "Unemployment", "Comparison", "Conclusion"],
+            [
+                ("GDP Growth", "bar", economies, ["2019", "2020", "2021", "2022", "2023"]),
+                ("Inflation", "line", ["2019", "2020", "2021", "2022", "2023"], economies),
+                ("Unemployment", "bar", economies, ["2019", "2020", "2021", "2022", "2023"]),
+                ("Growth vs Inflation", "scatter", economies, ["2023"]),
+            ]
+        ),
+        "advanced": _synthetic_report(
+            "Climate Change Analysis",
+            ["Overview", "Global Temperature", "Sea Level Rise", "Carbon Emissions",
+             "Correlations", "Future Scenarios", "Conclusion"],
+            [
+                ("Global Temperature Anomaly", "line", decades, ["Anomaly"]),
+                ("Sea Level Rise", "line", decades, ["Sea level"]),
+                ("Carbon Emissions", "bar", decades, ["CO2"]),
+                ("Emissions by Sector", "pie", ["Energy", "Industry", "Transport", "Agriculture"], ["Share"]),
+                ("Temperature vs Emissions", "scatter", decades, ["Anomaly"]),
+                ("Scenario Projections", "line", ["2030", "2050", "2070", "2100"], ["Low", "Medium", "High"]),
+            ],
+            paragraphs=6
+        ),
+    }
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    """Return the nearest-rank percentile of values."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(1, int(-(-percent * len(ordered) // 100)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+async def _abenchmark_level(llm: ReplayChatModel, instructions: List[str], concurrency: int,
+                            render_executor: str) -> Dict[str, Any]:
+    """Run the instructions at one concurrency level and summarize throughput."""
+    with tempfile.TemporaryDirectory(prefix="agent-bench-") as output_root:
+        agent = EnhancedLLMAgent(
+            openai_api_key="",
+            save_chart_files=False,
+            render_executor=render_executor,
+            output_manager=OutputManager(output_root, retention_days=None),
+            llm=llm
+        )
+        try:
+            started = time.perf_counter()
+            results = await agent.abatch_execute(instructions, concurrency)
+            elapsed = time.perf_counter() - started
+        finally:
+            agent.close()
+    
+    latencies = [result["metrics"]["total_time_s"] for result in results]
+    charts = sum(len(result["metrics"]["charts"]) for result in results)
+    pages = sum(result["metrics"]["pdf_pages"] for result in results)
+    
+    return {
+        "concurrency": concurrency,
+        "reports": len(results),
+        "errors": sum(1 for result in results if result.get("error")),
+        "elapsed_s": round(elapsed, 3),
+        "reports_per_s": round(len(results) / elapsed, 3),
+        "p50_latency_s": round(_percentile(latencies, 50), 3),
+        "p99_latency_s": round(_percentile(latencies, 99), 3),
+        "charts_per_s": round(charts / elapsed, 3),
+        "pdf_pages_per_s": round(pages / elapsed, 3),
+    }
+
+
+def run_benchmark(concurrency_levels: Tuple[int, ...] = (1, 4, 8), iterations: int = 2,
+                  latency_s: float = 0.5, responses_path: Optional[str] = None,
+                  render_executor: str = "thread") -> List[Dict[str, Any]]:
+    """Benchmark the predefined tasks offline against a ReplayChatModel.
+    
+    Each level runs every predefined task iterations times at the given
+    concurrency. Responses come from responses_path (see
+    ReplayChatModel.from_jsonl) or from build_benchmark_responses().
+    """
+    if responses_path:
+        llm = ReplayChatModel.from_jsonl(responses_path, latency_s=latency_s)
+    else:
+        recorded = build_benchmark_responses()
+        llm = ReplayChatModel(
+            {PREDEFINED_TASKS[name]: response for name, response in recorded.items()},
+            latency_s=latency_s
+        )
+    
+    # Number the runs so that every report gets its own chart specs
+    instructions = [
+        f"{PREDEFINED_TASKS[name]} (benchmark run {i+1})"
+        for i in range(iterations)
+        for name in PREDEFINED_TASKS
+    ]
+    return [
+        asyncio.run(_abenchmark_level(llm, instructions, concurrency, render_executor))
+        for concurrency in concurrency_levels
+    ]
+
+
+def format_benchmark(levels: List[Dict[str, Any]]) -> str:
+    """Format benchmark results as a table."""
+    header = f"{'conc':>5} {'reports':>8} {'rep/s':>8} {'p50 s':>8} {'p99 s':>8} {'charts/s':>9} {'pages/s':>8} {'errors':>7}"
+    lines = [header, "-" * len(header)]
+    for level in levels:
+        lines.append(
+            f"{level['concurrency']:>5} {level['reports']:>8} {level['reports_per_s']:>8.2f} "
+            f"{level['p50_latency_s']:>8.3f} {level['p99_latency_s']:>8.3f} {level['charts_per_s']:>9.2f} "
+            f"{level['pdf_pages_per_s']:>8.2f} {level['errors']:>7}"
+        )
+    return "\n".join(lines)
+
+
+def measure_startup(runs: int = 5, top: int = 10) -> Dict[str, Any]:
+    """Measure the cold-start import time of this module.
+    
+    Each run imports the module in a fresh interpreter with "-X importtime"
+    and records the wall time plus the slowest imports reported by Python.
+    """
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    module_name = os.path.splitext(os.path.basename(__file__))[0]
+    wall_times = []
+    import_times: Dict[str, List[int]] = {}
+    
+    for _ in range(runs):
+        start = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+            cwd=module_dir,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        wall_times.append(time.perf_counter() - start)
+        
+        # Lines look like "import time:  self [us] | cumulative | imported package";
+        # everything up to "site" is interpreter startup and is skipped
+        after_site = False
+        for line in completed.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            fields = line[len("import time:"):].split("|")
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            package = fields[2].strip()
+            if not after_site:
+                after_site = package == "site"
+                continue
+            import_times.setdefault(package, []).append(int(fields[1].strip()))
+    
+    slowest = sorted(
+        ((package, statistics.median(times)) for package, times in import_times.items()
+         if package != module_name),
+        key=lambda item: item[1],
+        reverse=True
+    )[:top]
+    
+    return {
+        "runs": runs,
+        "wall_time_min_s": min(wall_times),
+        "wall_time_median_s": statistics.median(wall_times),
+        "module_import_us": statistics.median(import_times.get(module_name, [0])),
+        "slowest_imports_us": slowest,
+    }
+
+
+def run_startup_benchmark(runs: int = 5) -> str:
+    """Run the startup benchmark and format the results."""
+    stats = measure_startup(runs)
+    
+    output_info = f"Startup benchmark ({stats['runs']} runs)\n"
+    output_info += f"Wall time (min): {stats['wall_time_min_s'] * 1000:.1f} ms\n"
+    output_info += f"Wall time (median): {stats['wall_time_median_s'] * 1000:.1f} ms\n"
+    output_info += f"Module import (median): {stats['module_import_us'] / 1000:.1f} ms\n"
+    output_info += "Slowest imports (cumulative):\n"
+    for package, micros in stats["slowest_imports_us"]:
+        output_info += f"  {package}: {micros / 1000:.1f} ms\n"
+    
+    return output_info
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Enhanced AI Assistant")
+    parser.add_argument("--dedup", choices=InstructionIndex.MODES,
+                        help="Serve or seed custom instructions from similar earlier ones")
+    parser.add_argument("--dedup-threshold", type=float, default=INSTRUCTION_INDEX_THRESHOLD,
+                        help="Minimum similarity (0-1) for two instructions to count as the same")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    subparsers.add_parser(
+        "dedup-check",
+        help="Score the built-in rewording and different-topic instruction pairs against --dedup-threshold"
+    )
+    
+    startup_parser = subparsers.add_parser(
+        "startup-benchmark",
+        help="Measure cold-start import time"
+    )
+    startup_parser.add_argument("--runs", type=int, default=5, help="Number of interpreter launches")
+    
+    benchmark_parser = subparsers.add_parser(
+        "benchmark",
+        help="Benchmark the predefined tasks offline with a replayed LLM"
+    )
+    benchmark_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8],
+                                  help="Concurrency levels to measure")
+    benchmark_parser.add_argument("--iterations", type=int, default=2, help="Runs of each task per level")
+    benchmark_parser.add_argument("--latency", type=float, default=0.5, help="Simulated LLM latency in seconds")
+    benchmark_parser.add_argument("--responses", help="JSONL file of recorded responses to replay")
+    benchmark_parser.add_argument("--render-executor", choices=["thread", "process"], default="thread")
+    benchmark_parser.add_argument("--output", help="Also write the results to this JSON file")
+    
+    batch_parser = subparsers.add_parser(
+        "batch",
+        help="Run the instructions in a JSONL job file without the interactive menu"
+    )
+    batch_parser.add_argument("jobs", help="JSONL file with one job per line")
+    batch_parser.add_argument("results", help="JSONL file that results are appended to")
+    batch_parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of jobs in flight")
+    metrics_group = batch_parser.add_mutually_exclusive_group()
+    metrics_group.add_argument("--metrics-jsonl", help="Append per-run metrics to this JSONL file")
+    metrics_group.add_argument("--metrics-prom", help="Keep aggregated metrics in this Prometheus text file")
+    batch_parser.add_argument("--compact-pdf", action="store_true",
+                              help="Compress PDF pages and share identical chart images")
+    batch_parser.add_argument("--planner", action="store_true",
+                              help="Split each instruction into sections written by concurrent LLM calls")
+    batch_parser.add_argument("--trace-memory", action="store_true",
+                              help="Record each run's peak Python memory with tracemalloc (slower)")
+    batch_parser.add_argument("--rpm", type=int, default=LLM_REQUESTS_PER_MINUTE,
+                              help="Client-side limit on LLM requests per minute")
+    batch_parser.add_argument("--tpm", type=int, default=LLM_TOKENS_PER_MINUTE,
+                              help="Client-side limit on LLM tokens per minute")
+    
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Run the job queue HTTP API with a pool of worker processes"
+    )
+    serve_parser.add_argument("--workers", type=int, default=2, help="Number of worker processes")
+    serve_parser.add_argument("--host", default=JOB_SERVICE_HOST, help="Address to listen on")
+    serve_parser.add_argument("--port", type=int, default=JOB_SERVICE_PORT, help="Port to listen on")
+    serve_parser.add_argument("--max-pending", type=int, default=JOB_QUEUE_MAX_PENDING,
+                              help="Unfinished jobs accepted before new ones are refused")
+    serve_parser.add_argument("--queue", default=JOB_QUEUE_PATH, help="SQLite job queue file")
+    serve_parser.add_argument("--compact-pdf", action="store_true",
+                              help="Compress PDF pages and share identical chart images")
+    serve_parser.add_argument("--planner", action="store_true",
+                              help="Split each instruction into sections written by concurrent LLM calls")
+    serve_parser.add_argument("--trace-memory", action="store_true",
+                              help="Record each job's peak Python memory with tracemalloc (slower)")
+    serve_parser.add_argument("--rpm", type=int, default=LLM_REQUESTS_PER_MINUTE,
+                              help="Client-side limit on LLM requests per minute, shared by all workers")
+    serve_parser.add_argument("--tpm", type=int, default=LLM_TOKENS_PER_MINUTE,
+                              help="Client-side limit on LLM tokens per minute, shared by all workers")
+    
+    submit_parser = subparsers.add_parser("submit", help="Queue a job for the job service")
+    submit_source = submit_parser.add_mutually_exclusive_group(required=True)
+    submit_source.add_argument("--instruction", help="Instruction to run")
+    submit_source.add_argument("--task", choices=sorted(PREDEFINED_TASKS), help="Predefined task to run")
+    submit_parser.add_argument("--id", help="Job id (generated if omitted)")
+    submit_parser.add_argument("--max-pending", type=int, default=JOB_QUEUE_MAX_PENDING,
+                               help="Unfinished jobs accepted before new ones are refused")
+    submit_parser.add_argument("--queue", default=JOB_QUEUE_PATH, help="SQLite job queue file")
+    
+    status_parser = subparsers.add_parser("status", help="Show a queued job, or the queue statistics")
+    status_parser.add_argument("id", nargs="?", help="Job id (omit for statistics)")
+    status_parser.add_argument("--queue", default=JOB_QUEUE_PATH, help="SQLite job queue file")
+    
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
     """Main function to run the interactive AI assistant."""
+    args = parse_args(argv)
+    
+    if args.command == "startup-benchmark":
+        print(run_startup_benchmark(args.runs))
+        return
+    
+    if args.command == "dedup-check":
+        check = check_instruction_threshold(args.dedup_threshold)
+        for pair in check["pairs"]:
+            print(f"{pair['similarity']:.3f}  {'same' if pair['same'] else 'diff'}  "
+                  f"{pair['stored']!r} / {pair['query']!r}")
+        print(f"Lowest same-report score: {check['lowest_same']:.3f}, "
+              f"highest different-report score: {check['highest_different']:.3f}")
+        print(f"Threshold {args.dedup_threshold} {'separates' if check['separates'] else 'does not separate'} them")
+        sys.exit(0 if check["separates"] else 1)
+    
+    if args.command == "benchmark":
+        levels = run_benchmark(
+            tuple(args.concurrency),
+            args.iterations,
+            args.latency,
+            args.responses,
+            args.render_executor
+        )
+        print(format_benchmark(levels))
+        if args.output:
+            atomic_write(args.output, json.dumps(levels, indent=2))
+        return
+    
+    if args.command in ("submit", "status"):
+        queue = JobQueue(args.queue, max_pending=getattr(args, "max_pending", JOB_QUEUE_MAX_PENDING))
+        try:
+            if args.command == "submit":
+                instruction = PREDEFINED_TASKS[args.task] if args.task else args.instruction
+                print(queue.submit(instruction, args.id))
+            elif args.id:
+                job = queue.get(args.id)
+                print(json.dumps(job, indent=2) if job else f"No job with id {args.id}")
+            else:
+                print(json.dumps(queue.stats(), indent=2))
+        except (QueueFullError, ValueError) as e:
+            print(f"Error: {str(e)}")
+            sys.exit(1)
+        finally:
+            queue.close()
+        return
+    
+    # Drop generated output that is past the retention period
+    OutputManager().cleanup()
+    
+    if args.command == "serve":
+        run_job_service(
+            args.queue,
+            args.workers,
+            args.host,
+            args.port,
+            args.max_pending,
+            {"compact_pdf": args.compact_pdf, "planner": args.planner},
+            trace_memory=args.trace_memory,
+            requests_per_minute=args.rpm,
+            tokens_per_minute=args.tpm
+        )
+        return
+    
+    if args.command == "batch":
+        metrics_sink = None
+        if args.metrics_jsonl:
+            metrics_sink = JSONLinesMetricsSink(args.metrics_jsonl)
+        elif args.metrics_prom:
+            metrics_sink = PrometheusMetricsSink(args.metrics_prom)
+        
+        agent = EnhancedLLMAgent(
+            openai_api_key=OPENAI_API_KEY,
+            openai_base_url=OPENAI_BASE_URL,
+            response_cache=LLMResponseCache(LLM_CACHE_PATH),
+            chart_cache=ChartDiskCache(CHART_CACHE_DIR),
+            client_factory=LLMClientFactory(requests_per_minute=args.rpm, tokens_per_minute=args.tpm),
+            metrics_sink=metrics_sink,
+            compact_pdf=args.compact_pdf,
+            planner=args.planner
+        )
+        if args.trace_memory:
+            tracemalloc.start()
+        try:
+            summary = run_batch(agent, args.jobs, args.results, args.concurrency)
+        finally:
+            agent.close()
+        print(f"Batch finished: {summary}")
+        return
+    
     print("\nInitializing Enhanced AI Assistant...")
     
     try:
         # Initialize the agent with embedded API key
         agent = EnhancedLLMAgent(
             openai_api_key=OPENAI_API_KEY,
-            openai_base_url=OPENAI_BASE_URL
+            openai_base_url=OPENAI_BASE_URL,
+            response_cache=LLMResponseCache(LLM_CACHE_PATH),
+            chart_cache=ChartDiskCache(CHART_CACHE_DIR)
         )
+        instruction_index = None
+        if args.dedup:
+            if args.dedup == "serve" and not check_instruction_threshold(args.dedup_threshold)["separates"]:
+                logger.warning(f"--dedup-threshold {args.dedup_threshold} does not separate the reference "
+                               "instruction pairs; run 'dedup-check' for details")
+            instruction_index = InstructionIndex(
+                threshold=args.dedup_threshold,
+                mode=args.dedup,
+                path=INSTRUCTION_INDEX_PATH
+            )
         
         while True:
             choice = display_menu()
@@ -494,11 +4698,16 @@ def main():
                 
             elif choice == 2:  # Run custom instruction
                 instruction = get_custom_instruction()
-                output_info = run_custom_instruction(agent, instruction)
+                output_info = run_custom_instruction(agent, instruction, instruction_index)
                 print(f"\nTask completed successfully!")
                 print(f"\n{output_info}")
                 
             else:  # Exit
+                if agent.response_cache is not None:
+                    logger.info(f"LLM response cache stats: {agent.response_cache.stats()}")
+                if instruction_index is not None:
+                    logger.info(f"Instruction index stats: {instruction_index.stats()}")
+                agent.close()
                 print("\nThank you for using the Enhanced AI Assistant. Goodbye!")
                 break
                 